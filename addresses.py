@@ -0,0 +1,64 @@
+import re
+import hashlib
+
+# USPS standard street suffix abbreviations for the suffixes seen around Austin.
+STREET_SUFFIXES = {
+    'ALLEY': 'ALY', 'AVENUE': 'AVE', 'AV': 'AVE', 'BEND': 'BND', 'BOULEVARD': 'BLVD', 'BLUFF': 'BLF',
+    'CANYON': 'CYN', 'CIRCLE': 'CIR', 'CIRC': 'CIR', 'COURT': 'CT', 'COVE': 'CV', 'CREEK': 'CRK',
+    'CROSSING': 'XING', 'DRIVE': 'DR', 'DRV': 'DR', 'EXPRESSWAY': 'EXPY', 'FREEWAY': 'FWY', 'GLEN': 'GLN',
+    'HEIGHTS': 'HTS', 'HIGHWAY': 'HWY', 'HILL': 'HL', 'HOLLOW': 'HOLW', 'LANE': 'LN', 'LOOP': 'LOOP',
+    'MEADOW': 'MDW', 'PARKWAY': 'PKWY', 'PKY': 'PKWY', 'PASS': 'PASS', 'PATH': 'PATH', 'PLACE': 'PL',
+    'PLAZA': 'PLZ', 'POINT': 'PT', 'RIDGE': 'RDG', 'ROAD': 'RD', 'RUN': 'RUN', 'SQUARE': 'SQ',
+    'STREET': 'ST', 'STR': 'ST', 'TERRACE': 'TER', 'TRAIL': 'TRL', 'TRACE': 'TRCE', 'VALLEY': 'VLY',
+    'VIEW': 'VW', 'VISTA': 'VIS', 'WAY': 'WAY',
+}
+
+DIRECTIONS = {
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+}
+
+# "Apt 4", "Unit #4", "# 4", "Ste. 200", "Bldg 3" -> "UNIT 4"
+UNIT_PATTERN = r'\s*(?:\b(?:APT|APARTMENT|UNIT|STE|SUITE|BLDG|BUILDING|NO)\b|#)\s*#?\s*([0-9A-Z-]*[0-9][0-9A-Z-]*)\s*$'
+ZIP_PATTERN = r'([0-9]{5})(?:-?[0-9]{4})?'
+
+def canonical_street(street):
+    """Upper-case street line with standard suffix / direction abbreviations
+    and any unit designator rewritten as a trailing 'UNIT <n>'.
+    """
+    if not street:
+        return ''
+    street = re.sub(r'[^0-9A-Z#\- ]', ' ', street.upper().replace('.', ''))
+    unit = None
+    m = re.search(UNIT_PATTERN, street)
+    if m:
+        unit = m.group(1)
+        street = street[:m.start()]
+    words = [DIRECTIONS.get(word, STREET_SUFFIXES.get(word, word)) for word in street.split()]
+    if unit:
+        words.extend(('UNIT', unit))
+    return ' '.join(words)
+
+def canonical_zip(postal):
+    """ZIP+4 and 'TX 78701' style values -> '78701'."""
+    m = re.search(ZIP_PATTERN, str(postal or ''))
+    return m.group(1) if m else ''
+
+def canonical_address(street, locality=None, region=None, postal=None):
+    """Canonical 'STREET|ZIP' form of an address. Locality and region only
+    stand in when there is no ZIP, since suburbs share ZIPs with Austin
+    and Redfin is not consistent about which city name it uses.
+    """
+    zip_code = canonical_zip(postal)
+    if zip_code:
+        return '{}|{}'.format(canonical_street(street), zip_code)
+    return '{}|{}|{}'.format(canonical_street(street), (locality or '').strip().upper(), (region or '').strip().upper())
+
+def address_key(street, locality=None, region=None, postal=None):
+    """Signed 64-bit hash of the canonical address, for an INTEGER column.
+    None when there is no street to key on.
+    """
+    if not street or street == 'NULL':
+        return None
+    digest = hashlib.sha1(canonical_address(street, locality, region, postal).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
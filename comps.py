@@ -0,0 +1,129 @@
+import math
+import sqlite3
+import argparse
+import statistics
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+def bounding_box(latitude, longitude, radius_miles):
+    """(min_lat, max_lat, min_lon, max_lon) enclosing a circle of radius_miles."""
+    dlat = radius_miles / MILES_PER_DEGREE_LAT
+    dlon = radius_miles / (MILES_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 1e-6))
+    return latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon
+
+def find_comps(conn, latitude, longitude, k=10, beds=None, baths=None, sqft=None,
+               bed_tolerance=1, bath_tolerance=1, sqft_tolerance=0.2,
+               radius_miles=0.25, max_radius_miles=10, exclude_id=None, sold_only=True):
+    """Return the k nearest sold listings similar to the given home, as
+    dicts ordered by distance. Only rows with a SOLD_DATE count, since the
+    PRICE of an active listing is an asking price; pass sold_only=False to
+    include them. Beds and baths must be within their tolerance and sqft
+    within sqft_tolerance (a fraction) when given.
+
+    The search starts with a small box on LISTING_RTREE and doubles the radius
+    until k matches lie inside the circle, so dense neighborhoods touch only a
+    handful of rows.
+
+    Raises ValueError with sold_only when no listing has a SOLD_DATE at all,
+    rather than quietly finding no comps.
+    """
+    filters, params = ['d.PRICE IS NOT NULL'], []
+    if sold_only:
+        if not conn.execute('SELECT 1 FROM LISTING_DETAILS WHERE SOLD_DATE IS NOT NULL LIMIT 1').fetchone():
+            raise ValueError('No listing has a SOLD_DATE; fetch the detail pages or enumerate the listings '
+                             'through the CSV export first, or pass sold_only=False')
+        filters.append('d.SOLD_DATE IS NOT NULL')
+    if beds is not None:
+        filters.append('d.NUMBER_OF_BEDS BETWEEN ? AND ?')
+        params.extend((beds - bed_tolerance, beds + bed_tolerance))
+    if baths is not None:
+        filters.append('d.NUMBER_OF_BATHS BETWEEN ? AND ?')
+        params.extend((baths - bath_tolerance, baths + bath_tolerance))
+    if sqft is not None:
+        filters.append('d.SQFT BETWEEN ? AND ?')
+        params.extend((sqft * (1 - sqft_tolerance), sqft * (1 + sqft_tolerance)))
+    if exclude_id is not None:
+        filters.append('d.LISTING_ID != ?')
+        params.append(exclude_id)
+
+    query = """
+        SELECT d.LISTING_ID, d.URL, d.STREET, d.POSTAL_CODE, d.PRICE, d.SOLD_DATE, d.NUMBER_OF_BEDS,
+               d.NUMBER_OF_BATHS, d.SQFT, d.YEAR_BUILT, d.LATITUDE, d.LONGITUDE
+        FROM LISTING_RTREE r
+        JOIN LISTING_DETAILS d ON d.LISTING_ID = r.LISTING_ID
+        WHERE r.MIN_LAT >= ? AND r.MAX_LAT <= ? AND r.MIN_LON >= ? AND r.MAX_LON <= ?
+          AND {}
+    """.format(' AND '.join(filters))
+    columns = ['LISTING_ID', 'URL', 'STREET', 'POSTAL_CODE', 'PRICE', 'SOLD_DATE', 'NUMBER_OF_BEDS',
+               'NUMBER_OF_BATHS', 'SQFT', 'YEAR_BUILT', 'LATITUDE', 'LONGITUDE']
+
+    radius = radius_miles
+    while True:
+        comps = []
+        for row in conn.execute(query, list(bounding_box(latitude, longitude, radius)) + params):
+            comp = dict(zip(columns, row))
+            comp['DISTANCE_MILES'] = haversine_miles(latitude, longitude, comp['LATITUDE'], comp['LONGITUDE'])
+            # Corners of the box are further away than the radius; anything there
+            # could be beaten by an unseen home just outside the box.
+            if comp['DISTANCE_MILES'] <= radius:
+                comps.append(comp)
+        if len(comps) >= k or radius >= max_radius_miles:
+            comps.sort(key=lambda comp: comp['DISTANCE_MILES'])
+            return comps[:k]
+        radius = min(radius * 2, max_radius_miles)
+
+def comps_for_listing(conn, url, k=10, **kwargs):
+    """find_comps for a listing already in LISTING_DETAILS, matched on its
+    own beds, baths and sqft.
+    """
+    row = conn.execute("""
+        SELECT LISTING_ID, LATITUDE, LONGITUDE, NUMBER_OF_BEDS, NUMBER_OF_BATHS, SQFT
+        FROM LISTING_DETAILS WHERE URL = ?""", (url,)).fetchone()
+    if not row or row[1] is None:
+        return []
+    listing_id, latitude, longitude, beds, baths, sqft = row
+    return find_comps(conn, latitude, longitude, k, beds, baths, sqft, exclude_id=listing_id, **kwargs)
+
+def comp_features(conn, latitude, longitude, k=10, **kwargs):
+    """Neighborhood features for the price model: median sale price,
+    median $/sqft and mean distance of the k nearest sold comps.
+    """
+    comps = find_comps(conn, latitude, longitude, k, **kwargs)
+    prices = [comp['PRICE'] for comp in comps]
+    price_per_sqft = [comp['PRICE'] / comp['SQFT'] for comp in comps if comp['SQFT']]
+    return {
+        'COMP_COUNT': len(comps),
+        'COMP_MEDIAN_PRICE': statistics.median(prices) if prices else None,
+        'COMP_MEDIAN_PRICE_PER_SQFT': statistics.median(price_per_sqft) if price_per_sqft else None,
+        'COMP_MEAN_DISTANCE_MILES': statistics.mean(comp['DISTANCE_MILES'] for comp in comps) if comps else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Comparable sales near a home.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--url', help='listing url path already in LISTING_DETAILS')
+    parser.add_argument('--lat', type=float)
+    parser.add_argument('--lon', type=float)
+    parser.add_argument('--beds', type=float)
+    parser.add_argument('--baths', type=float)
+    parser.add_argument('--sqft', type=float)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--include-active', action='store_true', help='also match listings that have not sold')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if args.url:
+        comps = comps_for_listing(conn, args.url, args.k, sold_only=not args.include_active)
+    else:
+        comps = find_comps(conn, args.lat, args.lon, args.k, args.beds, args.baths, args.sqft,
+                           sold_only=not args.include_active)
+    for comp in comps:
+        print('{DISTANCE_MILES:5.2f} mi  ${PRICE:>12,.0f}  {NUMBER_OF_BEDS} bd  {NUMBER_OF_BATHS} ba  '
+              '{SQFT} sqft  {STREET} {POSTAL_CODE}  sold {SOLD_DATE}'.format(**comp))
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+from xmlrpc.client import ServerProxy
+from xmlrpc.server import SimpleXMLRPCServer
+
+import redfin_urls
+from redfin_urls import get_page_info, scrape_home_info, needs_split, expand_partition, \
+    save_url_info, save_home_info, load_fetch_cache, create_tables_if_not_exist
+
+LEASE_SECONDS = 300
+# A shard leased this many times without being merged is marked failed.
+MAX_ATTEMPTS = 5
+HOME_BATCH_SIZE = 200
+MAX_LEVELS = 6
+
+STAGE_FUNCTIONS = {
+    'partition': get_page_info,
+    'homes': scrape_home_info,
+}
+
+def create_shard_table():
+    conn = sqlite3.connect(redfin_urls.SQLITE_DB_PATH)
+    conn.execute('''CREATE TABLE IF NOT EXISTS SHARDS
+             (
+             SHARD_ID       INTEGER PRIMARY KEY,
+             STAGE          TEXT    NOT NULL,
+             LEVEL          INT     DEFAULT 0,
+             PAYLOAD        TEXT    NOT NULL,
+             STATUS         TEXT    DEFAULT 'pending',
+             WORKER         TEXT,
+             LEASE_EXPIRES  REAL,
+             ATTEMPTS       INT     DEFAULT 0,
+             UNIQUE (STAGE, PAYLOAD));''')
+    conn.close()
+
+def add_shards(db, stage, url_batches, level=0):
+    """Queue batches of urls as pending shards. A batch that is
+    already queued is ignored, so seeding twice is harmless.
+    """
+    db.executemany("""
+        INSERT OR IGNORE INTO SHARDS (STAGE, LEVEL, PAYLOAD)
+        VALUES (?, ?, ?)""", [(stage, level, json.dumps(batch)) for batch in url_batches])
+
+def seed_partition(base_url):
+    """Queue base_url as the root of the filter partition crawl."""
+    with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+        add_shards(db, 'partition', [[base_url]])
+
+def seed_homes(batch_size=HOME_BATCH_SIZE, site='https://www.redfin.com'):
+    """Queue every home url in LISTING_DETAILS in batches of batch_size."""
+    with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+        cursor = db.execute("""
+            SELECT DISTINCT URL
+            FROM LISTING_DETAILS
+        """)
+        urls = [site + url_tail for url_tail, in cursor]
+        batches = [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+        add_shards(db, 'homes', batches)
+    print('Queued {} home urls in {} shards'.format(len(urls), len(batches)))
+
+def retry_failed_shards():
+    """Put failed shards back in the queue with a fresh attempt count."""
+    with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+        retried = db.execute("""
+            UPDATE SHARDS SET STATUS = 'pending', WORKER = NULL, ATTEMPTS = 0
+            WHERE STATUS = 'failed'""").rowcount
+    print('Requeued {} failed shards'.format(retried))
+
+
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class Coordinator:
+    """Hands out leased shards of the crawl frontier to worker nodes
+    and merges their results back into the local database.
+    A shard whose lease runs out is handed to the next worker that asks,
+    until it has been leased max_attempts times, and a shard is only ever
+    merged once, no matter how many workers finish it.
+    """
+
+    def __init__(self, base_url, lease_seconds=LEASE_SECONDS, max_levels=MAX_LEVELS, max_attempts=MAX_ATTEMPTS):
+        self.base_url = base_url
+        self.lease_seconds = lease_seconds
+        self.max_levels = max_levels
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+    def lease(self, worker_id):
+        """Lease the oldest pending shard to worker_id. Returns an empty
+        dict when nothing is pending, and {'done': True} once every shard
+        has been merged or has failed.
+        """
+        now = time.time()
+        with self.lock, sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+            failed = db.execute("""
+                UPDATE SHARDS SET STATUS = 'failed', WORKER = NULL
+                WHERE STATUS = 'leased' AND LEASE_EXPIRES < ? AND ATTEMPTS >= ?""",
+                (now, self.max_attempts)).rowcount
+            if failed:
+                print('Giving up on {} shards after {} attempts'.format(failed, self.max_attempts))
+            expired = db.execute("""
+                UPDATE SHARDS SET STATUS = 'pending', WORKER = NULL
+                WHERE STATUS = 'leased' AND LEASE_EXPIRES < ?""", (now,)).rowcount
+            if expired:
+                print('Reassigning {} expired shards'.format(expired))
+            row = db.execute("""
+                SELECT SHARD_ID, STAGE, PAYLOAD FROM SHARDS
+                WHERE STATUS = 'pending'
+                ORDER BY SHARD_ID LIMIT 1""").fetchone()
+            if not row:
+                remaining = db.execute("SELECT COUNT(*) FROM SHARDS WHERE STATUS = 'leased'").fetchone()[0]
+                return {} if remaining else {'done': True}
+            shard_id, stage, payload = row
+            db.execute("""
+                UPDATE SHARDS SET STATUS = 'leased', WORKER = ?, LEASE_EXPIRES = ?, ATTEMPTS = ATTEMPTS + 1
+                WHERE SHARD_ID = ?""", (worker_id, now + self.lease_seconds, shard_id))
+        urls = json.loads(payload)
+        validators = {}
+        if stage == 'homes':
+            validators = {url: list(cached) for url, cached in load_fetch_cache(urls).items()}
+        print('Leased shard {} ({}, {} urls) to {}'.format(shard_id, stage, len(urls), worker_id))
+        return {'shard_id': shard_id, 'stage': stage, 'urls': urls,
+                'validators': validators, 'lease_seconds': self.lease_seconds}
+
+    def renew(self, shard_id, worker_id):
+        """Extend the lease on a shard the worker is still processing.
+        Returns False if the lease was lost to another worker.
+        """
+        with self.lock, sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+            return db.execute("""
+                UPDATE SHARDS SET LEASE_EXPIRES = ?
+                WHERE SHARD_ID = ? AND WORKER = ? AND STATUS = 'leased'""",
+                (time.time() + self.lease_seconds, shard_id, worker_id)).rowcount == 1
+
+    def submit(self, shard_id, worker_id, results):
+        """Merge the results for a shard leased to worker_id. The merge and
+        the shard's move to 'done' are one transaction, so a crash part way
+        through leaves the shard to be merged again from scratch. Results
+        from a worker that no longer holds the lease, or for a shard already
+        merged, are dropped, which keeps retries idempotent.
+        """
+        results = [result for result in results if result]
+        with self.lock, sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+            claimed = db.execute("""
+                UPDATE SHARDS SET STATUS = 'done'
+                WHERE SHARD_ID = ? AND WORKER = ? AND STATUS = 'leased'""", (shard_id, worker_id)).rowcount
+            if not claimed:
+                print('Dropping results for shard {} from {}, which does not hold its lease'.format(
+                    shard_id, worker_id))
+                return False
+            stage, level = db.execute("SELECT STAGE, LEVEL FROM SHARDS WHERE SHARD_ID = ?", (shard_id,)).fetchone()
+            if stage == 'partition':
+                save_url_info(results, db)
+                self._expand(db, results, level)
+            else:
+                save_home_info([(url, tuple(validators), details) for url, validators, details in results], db)
+        print('Merged shard {} from {}'.format(shard_id, worker_id))
+        return True
+
+    def _expand(self, db, results, level):
+        # Same splitting rule as url_partition, one shard per sub-url.
+        if level + 1 >= self.max_levels:
+            return
+        new_urls = []
+        for result in results:
+            if needs_split(result) or level == 0:
+                new_urls.extend(expand_partition(result[0], self.base_url))
+        add_shards(db, 'partition', [[url] for url in new_urls], level + 1)
+
+    def progress(self):
+        """Return shard counts keyed by 'stage/status'."""
+        with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+            cursor = db.execute("SELECT STAGE, STATUS, COUNT(*) FROM SHARDS GROUP BY STAGE, STATUS")
+            return {'{}/{}'.format(stage, status): count for stage, status, count in cursor}
+
+
+def run_coordinator(base_url, host='0.0.0.0', port=8000, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    server = ThreadedXMLRPCServer((host, port), allow_none=True, logRequests=False)
+    server.register_instance(Coordinator(base_url, lease_seconds, max_attempts=max_attempts))
+    print('Coordinator listening on {}:{}'.format(host, port))
+    server.serve_forever()
+
+def keep_lease_alive(coordinator_url, shard_id, worker_id, lease_seconds, finished):
+    """Renew a shard lease every third of its length until finished is set."""
+    coordinator = ServerProxy(coordinator_url, allow_none=True)
+    while not finished.wait(lease_seconds / 3):
+        if not coordinator.renew(shard_id, worker_id):
+            print('{}: lost lease on shard {}'.format(worker_id, shard_id))
+            return
+
+def run_worker(coordinator_url, proxies, processes=8, worker_id=None, poll_seconds=10):
+    """Lease shards from the coordinator until the frontier is exhausted,
+    scraping each shard with a local process pool.
+    """
+    worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+    coordinator = ServerProxy(coordinator_url, allow_none=True)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while True:
+            shard = coordinator.lease(worker_id)
+            if shard.get('done'):
+                print('{}: frontier exhausted'.format(worker_id))
+                return
+            if not shard:
+                time.sleep(poll_seconds)
+                continue
+
+            if shard['stage'] == 'homes':
+                inputs = [(url, proxies, tuple(shard['validators'].get(url) or ()) or None) for url in shard['urls']]
+            else:
+                inputs = [(url, proxies) for url in shard['urls']]
+
+            # Keep the lease alive while the pool works through the shard.
+            finished = threading.Event()
+            threading.Thread(target=keep_lease_alive, daemon=True,
+                             args=(coordinator_url, shard['shard_id'], worker_id, shard['lease_seconds'], finished)).start()
+            try:
+                results = list(executor.map(STAGE_FUNCTIONS[shard['stage']], inputs))
+            finally:
+                finished.set()
+            coordinator.submit(shard['shard_id'], worker_id, results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distributed Redfin crawl over leased shards.')
+    subparsers = parser.add_subparsers(dest='role', required=True)
+
+    coordinator_parser = subparsers.add_parser('coordinator')
+    coordinator_parser.add_argument('--base-url', default='https://www.redfin.com/city/30818/TX/Austin/filter/include=forsale+mlsfsbo+construction+fsbo+sold-3yr')
+    coordinator_parser.add_argument('--host', default='0.0.0.0')
+    coordinator_parser.add_argument('--port', type=int, default=8000)
+    coordinator_parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS)
+    coordinator_parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    coordinator_parser.add_argument('--seed', choices=['partition', 'homes'])
+    coordinator_parser.add_argument('--retry-failed', action='store_true', help='requeue shards that ran out of attempts')
+
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('--coordinator', default='http://localhost:8000')
+    worker_parser.add_argument('--processes', type=int, default=8)
+    worker_parser.add_argument('--worker-id')
+    worker_parser.add_argument('--proxy-csv', default='proxy.csv')
+    worker_parser.add_argument('--direct', action='store_true', help='fetch without proxies, e.g. from a local stand-in')
+
+    args = parser.parse_args()
+
+    if args.role == 'coordinator':
+        create_tables_if_not_exist()
+        create_shard_table()
+        if args.seed == 'partition':
+            seed_partition(args.base_url)
+        elif args.seed == 'homes':
+            seed_homes(site='{0.scheme}://{0.netloc}'.format(urlparse(args.base_url)))
+        if args.retry_failed:
+            retry_failed_shards()
+        run_coordinator(args.base_url, args.host, args.port, args.lease_seconds, args.max_attempts)
+    else:
+        proxies = [] if args.direct else pd.read_csv(args.proxy_csv, encoding='utf-8').values.tolist()
+        run_worker(args.coordinator, proxies, args.processes, args.worker_id)
@@ -0,0 +1,143 @@
+import os
+import json
+import sqlite3
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+FEATURE_DIR = 'features'
+
+# Model inputs, in matrix column order. Missing values are stored as NaN.
+MODEL_FEATURES = ['NUMBER_OF_BEDS', 'NUMBER_OF_BATHS', 'SQFT', 'YEAR_BUILT', 'LATITUDE', 'LONGITUDE',
+                  'NUMBER_OF_ROOMS', 'WALK_SCORE', 'TRANSIT_SCORE', 'BIKE_SCORE', 'NUMBER_OF_PARKING_SPACES',
+                  'NUMBER_OF_FIREPLACES', 'NUMBER_OF_STORIES', 'HOA', 'HOA_DUES', 'POOL', 'DAYS_ON_MARKET',
+                  'SOLD_YEARS', 'MEAN_SCHOOL_RATING', 'NEAREST_SCHOOL_MILES']
+
+FEATURE_QUERY = """
+    SELECT d.LISTING_ID,
+           d.NUMBER_OF_BEDS, d.NUMBER_OF_BATHS, d.SQFT, d.YEAR_BUILT, d.LATITUDE, d.LONGITUDE,
+           d.NUMBER_OF_ROOMS, d.WALK_SCORE, d.TRANSIT_SCORE, d.BIKE_SCORE, d.NUMBER_OF_PARKING_SPACES,
+           d.NUMBER_OF_FIREPLACES, d.NUMBER_OF_STORIES, d.HOA, d.HOA_DUES, d.POOL, d.DAYS_ON_MARKET,
+           (JULIANDAY(d.SOLD_DATE) - JULIANDAY('2000-01-01')) / 365.25,
+           (SELECT AVG(s.RATING) FROM LISTING_SCHOOLS ls JOIN SCHOOLS s ON s.SCHOOL_ID = ls.SCHOOL_ID
+            WHERE ls.LISTING_ID = d.LISTING_ID),
+           (SELECT MIN(ls.DISTANCE_MILES) FROM LISTING_SCHOOLS ls WHERE ls.LISTING_ID = d.LISTING_ID),
+           d.PRICE
+    FROM LISTING_DETAILS d
+    WHERE d.PRICE > 0 AND d.SOLD_DATE IS NOT NULL AND d.ROW_VERSION > ? AND d.ROW_VERSION <= ?
+    ORDER BY d.LISTING_ID
+"""
+
+def write_feature_matrix(conn, feature_dir=FEATURE_DIR, chunk_size=10000, after_version=None):
+    """Write the sold listings to feature_dir as memory-mapped .npy files:
+    X (float64, rows x MODEL_FEATURES), y (log sale price) and LISTING_ID,
+    plus meta.json with per-column mean / std. Listings without a SOLD_DATE
+    are left out, since their PRICE is an asking price. With after_version,
+    only listings added or changed since that ROW_VERSION are written.
+    Rows are read with fetchmany and written chunk by chunk, so memory use
+    depends on chunk_size, not on the number of listings.
+
+    X is float64 because HistGradientBoostingRegressor converts anything
+    else to a float64 copy before binning.
+    """
+    os.makedirs(feature_dir, exist_ok=True)
+    # Rows from before ROW_VERSION existed have version 0.
+    low = -1 if after_version is None else after_version
+    max_version = conn.execute('SELECT VERSION FROM LISTING_VERSION').fetchone()[0]
+    max_id = conn.execute('SELECT MAX(LISTING_ID) FROM LISTING_DETAILS').fetchone()[0] or 0
+    count = conn.execute("""
+        SELECT COUNT(*) FROM LISTING_DETAILS
+        WHERE PRICE > 0 AND SOLD_DATE IS NOT NULL AND ROW_VERSION > ? AND ROW_VERSION <= ?""",
+                         (low, max_version)).fetchone()[0]
+    if not count and after_version is None:
+        priced = conn.execute('SELECT COUNT(*) FROM LISTING_DETAILS WHERE PRICE > 0').fetchone()[0]
+        if priced:
+            raise ValueError('None of the {} priced listings has a SOLD_DATE; fetch their detail pages '
+                             'or enumerate them through the CSV export first'.format(priced))
+
+    X = open_memmap(os.path.join(feature_dir, 'X.npy'), mode='w+', dtype=np.float64,
+                    shape=(count, len(MODEL_FEATURES)))
+    y = open_memmap(os.path.join(feature_dir, 'y.npy'), mode='w+', dtype=np.float64, shape=(count,))
+    listing_ids = open_memmap(os.path.join(feature_dir, 'listing_id.npy'), mode='w+', dtype=np.int64, shape=(count,))
+
+    sums = np.zeros(len(MODEL_FEATURES))
+    squares = np.zeros(len(MODEL_FEATURES))
+    counts = np.zeros(len(MODEL_FEATURES))
+    rows = 0
+    cursor = conn.execute(FEATURE_QUERY, (low, max_version))
+    while rows < count:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        chunk = np.array([[np.nan if value is None else value for value in row] for row in chunk[:count - rows]],
+                         dtype=np.float64)
+        end = rows + len(chunk)
+        listing_ids[rows:end] = chunk[:, 0]
+        X[rows:end] = chunk[:, 1:-1]
+        y[rows:end] = np.log(chunk[:, -1])
+        present = ~np.isnan(chunk[:, 1:-1])
+        values = np.where(present, chunk[:, 1:-1], 0)
+        sums += values.sum(axis=0)
+        squares += (values ** 2).sum(axis=0)
+        counts += present.sum(axis=0)
+        rows = end
+    # In a full matrix, a column nobody has scraped yet is stored as 0 instead
+    # of NaN, since the histogram binning cannot handle a feature with no
+    # values at all. A delta keeps its NaNs: a feature missing from the new
+    # rows only is missing, not 0 (warm_start deals with it at fit time).
+    if after_version is None:
+        for column in np.flatnonzero(counts == 0):
+            X[:, column] = 0
+    for array in (X, y, listing_ids):
+        array.flush()
+
+    mean = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    variance = np.divide(squares, counts, out=np.zeros_like(sums), where=counts > 0) - mean ** 2
+    meta = {
+        'columns': MODEL_FEATURES,
+        # Listings can be folded away by dedupe between the count and the
+        # read, so only the first `rows` rows are valid.
+        'rows': rows,
+        'after_version': after_version,
+        'max_version': max_version,
+        'max_listing_id': max_id,
+        'counts': counts.astype(int).tolist(),
+        'mean': mean.tolist(),
+        'std': np.sqrt(np.maximum(variance, 0)).tolist(),
+    }
+    with open(os.path.join(feature_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print('Wrote {} x {} feature matrix to {}'.format(rows, len(MODEL_FEATURES), feature_dir))
+    return meta
+
+def load_feature_matrix(feature_dir=FEATURE_DIR):
+    """(X, y, listing_ids, meta) with the arrays memory-mapped read-only."""
+    with open(os.path.join(feature_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    rows = meta['rows']
+    X, y, listing_ids = (np.load(os.path.join(feature_dir, name + '.npy'), mmap_mode='r')[:rows]
+                         for name in ('X', 'y', 'listing_id'))
+    return X, y, listing_ids, meta
+
+def iter_batches(n, batch_size, seed=None):
+    """Contiguous (start, stop) slices covering n rows, in shuffled order
+    when a seed is given. Contiguous slices of a memmap are read without
+    copying the rest of the file.
+    """
+    starts = np.arange(0, n, batch_size)
+    if seed is not None:
+        np.random.default_rng(seed).shuffle(starts)
+    for start in starts:
+        yield int(start), int(min(start + batch_size, n))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the price model feature matrix from LISTING_DETAILS.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--feature-dir', default=FEATURE_DIR)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    write_feature_matrix(conn, args.feature_dir, args.chunk_size)
+    conn.close()
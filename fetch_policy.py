@@ -0,0 +1,140 @@
+import os
+import time
+import sqlite3
+from urllib.parse import urlparse
+
+# Shared by every process that fetches. Read from the environment so pool
+# workers agree on it whether they are forked or spawned.
+BREAKER_DB_PATH = os.environ.get('REDFIN_BREAKER_DB', 'circuit-breakers.db')
+
+
+class FetchError(Exception):
+    """A request that failed for good after its retry policy ran out."""
+
+
+class NetworkError(FetchError):
+    """Timeouts, refused connections, dead proxies and 5xx responses."""
+
+
+class BlockedError(FetchError):
+    """403 / 429 responses, i.e. the site is rate limiting or blocking us."""
+
+
+class NotFoundError(FetchError):
+    """404 / 410 responses. The listing is gone and retrying will not help."""
+
+
+class ParseError(Exception):
+    """A required field is missing from a page that was fetched fine.
+    Never retried, since refetching returns the same page.
+    """
+
+
+# failure class -> (max attempts, base backoff in seconds).
+# None attempts means one attempt per proxy, plus one.
+RETRY_POLICY = {
+    NetworkError: (None, 0),
+    BlockedError: (4, 15),
+    NotFoundError: (1, 0),
+}
+
+def classify_response(resp):
+    """Return the FetchError a response stands for, or None if it is usable."""
+    if resp.status_code in (403, 429):
+        return BlockedError('{} from {}'.format(resp.status_code, resp.url))
+    if resp.status_code in (404, 410):
+        return NotFoundError('{} from {}'.format(resp.status_code, resp.url))
+    if resp.status_code >= 400:
+        return NetworkError('{} from {}'.format(resp.status_code, resp.url))
+    return None
+
+def retry_delay(error_class, attempt):
+    """Exponential backoff for the given attempt (1-based) of a failure class."""
+    _, backoff = RETRY_POLICY[error_class]
+    return backoff * 2 ** (attempt - 1)
+
+
+class CircuitBreaker:
+    """Per-host breaker that trips after threshold consecutive blocked
+    responses and holds every request to that host for a cooldown, which
+    doubles each time the breaker trips again without a success in between.
+    The state is a row in a small SQLite database, so every process on the
+    machine (pool workers, local crawl workers) trips and backs off together.
+    """
+
+    def __init__(self, host, threshold=3, cooldown=60, max_cooldown=1800, db_path=None):
+        self.host = host
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.db_path = db_path or BREAKER_DB_PATH
+        self.conn = None
+        self.pid = None
+
+    def connect(self):
+        # One connection per process; a forked worker must not reuse its parent's.
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS CIRCUIT_BREAKERS
+                    (
+                    HOST           TEXT    PRIMARY KEY,
+                    BLOCKS         INT     DEFAULT 0,
+                    COOLDOWN       REAL,
+                    OPEN_UNTIL     REAL    DEFAULT 0);''')
+            self.conn.execute('INSERT OR IGNORE INTO CIRCUIT_BREAKERS (HOST, COOLDOWN) VALUES (?, ?)',
+                              (self.host, self.base_cooldown))
+            self.pid = os.getpid()
+        return self.conn
+
+    def state(self):
+        """(consecutive blocks, next cooldown, open until) for the host."""
+        return self.connect().execute("""
+            SELECT BLOCKS, COOLDOWN, OPEN_UNTIL FROM CIRCUIT_BREAKERS WHERE HOST = ?""", (self.host,)).fetchone()
+
+    def wait(self):
+        """Sleep until the breaker lets the next request through."""
+        remaining = self.state()[2] - time.time()
+        if remaining > 0:
+            print('Circuit open, holding requests for {:.0f}s'.format(remaining))
+            time.sleep(remaining)
+
+    def record_success(self):
+        # Only write when there is something to reset, so successes stay reads.
+        blocks, cooldown, _ = self.state()
+        if blocks or cooldown != self.base_cooldown:
+            self.connect().execute('UPDATE CIRCUIT_BREAKERS SET BLOCKS = 0, COOLDOWN = ? WHERE HOST = ?',
+                                   (self.base_cooldown, self.host))
+
+    def record_block(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            blocks, cooldown, open_until = self.state()
+            now = time.time()
+            if open_until > now:
+                # Requests already in flight when the breaker tripped; the
+                # cooldown running now covers them.
+                return
+            blocks += 1
+            if blocks >= self.threshold:
+                open_until = now + cooldown
+                print('Circuit tripped after {} blocked responses, cooling down {}s'.format(blocks, cooldown))
+                cooldown = min(cooldown * 2, self.max_cooldown)
+                blocks = 0
+            conn.execute('UPDATE CIRCUIT_BREAKERS SET BLOCKS = ?, COOLDOWN = ?, OPEN_UNTIL = ? WHERE HOST = ?',
+                         (blocks, cooldown, open_until, self.host))
+        finally:
+            conn.execute('COMMIT')
+
+
+BREAKERS = {}
+
+def breaker_for(url):
+    """Return the circuit breaker for the host of url. The breaker object is
+    per process, its state is shared through BREAKER_DB_PATH.
+    """
+    host = urlparse(url).netloc
+    if host not in BREAKERS:
+        BREAKERS[host] = CircuitBreaker(host)
+    return BREAKERS[host]
@@ -0,0 +1,513 @@
+import re
+import sqlite3
+import argparse
+from datetime import datetime
+from urllib.parse import urlparse
+
+from addresses import address_key
+from rollups import create_rollup_tables, has_rollups, rebuild_rollups, update_rollups
+
+# Typed LISTING_DETAILS: one row per listing url, schools split out into
+# SCHOOLS (one row per school) and LISTING_SCHOOLS (which schools a listing
+# is near, and how far away).
+LISTING_DETAILS_DDL = '''CREATE TABLE IF NOT EXISTS LISTING_DETAILS
+            (
+            LISTING_ID                INTEGER PRIMARY KEY,
+            URL                       TEXT    NOT NULL UNIQUE,
+            NAME                      TEXT,
+            TYPE                      TEXT,
+            COUNTRY                   TEXT,
+            STREET                    TEXT,
+            LOCALITY                  TEXT,
+            REGION                    TEXT,
+            POSTAL_CODE               TEXT,
+            PRICE                     REAL,
+            NUMBER_OF_ROOMS           INT,
+            NUMBER_OF_BEDS            REAL,
+            NUMBER_OF_BATHS           REAL,
+            WALK_SCORE                INT,
+            TRANSIT_SCORE             INT,
+            BIKE_SCORE                INT,
+            NUMBER_OF_DINING_ROOMS    INT,
+            NUMBER_OF_LIVING_ROOMS    INT,
+            NUMBER_OF_OTHER_ROOMS     INT,
+            DINING_ROOM_DESCRIPTION   TEXT,
+            KITCHEN_FEATURES          TEXT,
+            KITCHEN_APPLIANCES        TEXT,
+            SCHOOL_DISTRICT           TEXT,
+            NUMBER_OF_PARKING_SPACES  INT,
+            PARKING_FEATURES          TEXT,
+            YEAR_BUILT                INT,
+            NUMBER_OF_FIREPLACES      INT,
+            HOA                       INT,
+            HOA_DUES                  REAL,
+            POOL                      INT,
+            POOL_FEATURES             TEXT,
+            NUMBER_OF_STORIES         INT,
+            AREA_AMENITIES            TEXT,
+            LATITUDE                  REAL,
+            LONGITUDE                 REAL,
+            SQFT                      REAL,
+            ADDRESS_KEY               INT,
+            SOLD_DATE                 TEXT,
+            DAYS_ON_MARKET            INT,
+            ROW_VERSION               INT     DEFAULT 0
+            );'''
+
+# Columns added after the typed schema shipped, created on older databases
+# by create_listing_tables.
+ADDED_COLUMNS = [
+    ('LATITUDE', 'REAL'),
+    ('LONGITUDE', 'REAL'),
+    ('SQFT', 'REAL'),
+    ('ADDRESS_KEY', 'INT'),
+    ('SOLD_DATE', 'TEXT'),
+    ('DAYS_ON_MARKET', 'INT'),
+    ('ROW_VERSION', 'INT DEFAULT 0'),
+]
+
+# Change sequence for LISTING_DETAILS. Every insert, and every update that
+# changes a value, stamps the row with the next version, so the rows changed
+# since a given version are one range scan. Kept in its own table instead of
+# MAX(ROW_VERSION) + 1 so that versions keep growing when the newest rows are
+# deleted, and LISTING_ID is no use since ids are reused after a dedupe.
+LISTING_VERSION_DDL = '''CREATE TABLE IF NOT EXISTS LISTING_VERSION
+            (
+            VERSION                   INT     NOT NULL
+            );'''
+
+# R*Tree over listing coordinates, kept in sync with LISTING_DETAILS by triggers.
+# The triggers delete before inserting: an UPSERT's own conflict policy
+# overrides INSERT OR REPLACE inside a trigger.
+LISTING_RTREE_DDL = '''CREATE VIRTUAL TABLE IF NOT EXISTS LISTING_RTREE USING rtree
+            (
+            LISTING_ID,
+            MIN_LAT, MAX_LAT,
+            MIN_LON, MAX_LON
+            );'''
+
+LISTING_RTREE_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS LISTING_RTREE_INSERT AFTER INSERT ON LISTING_DETAILS
+       WHEN NEW.LATITUDE IS NOT NULL AND NEW.LONGITUDE IS NOT NULL
+       BEGIN
+           DELETE FROM LISTING_RTREE WHERE LISTING_ID = NEW.LISTING_ID;
+           INSERT INTO LISTING_RTREE VALUES
+               (NEW.LISTING_ID, NEW.LATITUDE, NEW.LATITUDE, NEW.LONGITUDE, NEW.LONGITUDE);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS LISTING_RTREE_UPDATE AFTER UPDATE OF LATITUDE, LONGITUDE ON LISTING_DETAILS
+       WHEN NEW.LATITUDE IS NOT NULL AND NEW.LONGITUDE IS NOT NULL
+       BEGIN
+           DELETE FROM LISTING_RTREE WHERE LISTING_ID = NEW.LISTING_ID;
+           INSERT INTO LISTING_RTREE VALUES
+               (NEW.LISTING_ID, NEW.LATITUDE, NEW.LATITUDE, NEW.LONGITUDE, NEW.LONGITUDE);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS LISTING_RTREE_DELETE AFTER DELETE ON LISTING_DETAILS
+       BEGIN
+           DELETE FROM LISTING_RTREE WHERE LISTING_ID = OLD.LISTING_ID;
+       END''',
+]
+
+SCHOOLS_DDL = '''CREATE TABLE IF NOT EXISTS SCHOOLS
+            (
+            SCHOOL_ID                 INTEGER PRIMARY KEY,
+            TITLE                     TEXT    NOT NULL UNIQUE,
+            RATING                    INT
+            );'''
+
+LISTING_SCHOOLS_DDL = '''CREATE TABLE IF NOT EXISTS LISTING_SCHOOLS
+            (
+            LISTING_ID                INT     NOT NULL REFERENCES LISTING_DETAILS (LISTING_ID),
+            RANK                      INT     NOT NULL,
+            SCHOOL_ID                 INT     NOT NULL REFERENCES SCHOOLS (SCHOOL_ID),
+            DISTANCE_MILES            REAL,
+            PRIMARY KEY (LISTING_ID, RANK)
+            ) WITHOUT ROWID;'''
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS IDX_LISTING_POSTAL_YEAR_PRICE ON LISTING_DETAILS (POSTAL_CODE, YEAR_BUILT, PRICE)',
+    'CREATE INDEX IF NOT EXISTS IDX_LISTING_PRICE ON LISTING_DETAILS (PRICE)',
+    'CREATE INDEX IF NOT EXISTS IDX_LISTING_YEAR_PRICE ON LISTING_DETAILS (YEAR_BUILT, PRICE)',
+    'CREATE INDEX IF NOT EXISTS IDX_LISTING_SCHOOLS_SCHOOL ON LISTING_SCHOOLS (SCHOOL_ID)',
+    'CREATE INDEX IF NOT EXISTS IDX_LISTING_ROW_VERSION ON LISTING_DETAILS (ROW_VERSION)',
+]
+
+# parse_home_info output, in order, after the three school triples are taken out.
+DETAIL_COLUMNS = ['STREET', 'LOCALITY', 'REGION', 'POSTAL_CODE', 'PRICE', 'NUMBER_OF_BEDS', 'NUMBER_OF_BATHS',
+                  'WALK_SCORE', 'TRANSIT_SCORE', 'BIKE_SCORE']
+FEATURE_COLUMNS = ['NUMBER_OF_DINING_ROOMS', 'NUMBER_OF_LIVING_ROOMS', 'NUMBER_OF_OTHER_ROOMS',
+                   'DINING_ROOM_DESCRIPTION', 'KITCHEN_FEATURES', 'KITCHEN_APPLIANCES', 'SCHOOL_DISTRICT',
+                   'NUMBER_OF_PARKING_SPACES', 'PARKING_FEATURES', 'YEAR_BUILT', 'NUMBER_OF_FIREPLACES',
+                   'HOA', 'HOA_DUES', 'POOL', 'POOL_FEATURES', 'NUMBER_OF_STORIES', 'AREA_AMENITIES']
+STATUS_COLUMNS = ['SOLD_DATE']
+SUMMARY_COLUMNS = ['NUMBER_OF_ROOMS', 'NAME', 'COUNTRY', 'REGION', 'LOCALITY', 'STREET', 'POSTAL_CODE', 'TYPE', 'PRICE',
+                   'LATITUDE', 'LONGITUDE', 'SQFT']
+
+REAL_COLUMNS = {'PRICE', 'NUMBER_OF_BEDS', 'NUMBER_OF_BATHS', 'HOA_DUES', 'LATITUDE', 'LONGITUDE', 'SQFT'}
+INT_COLUMNS = {'NUMBER_OF_ROOMS', 'WALK_SCORE', 'TRANSIT_SCORE', 'BIKE_SCORE', 'NUMBER_OF_DINING_ROOMS',
+               'NUMBER_OF_LIVING_ROOMS', 'NUMBER_OF_OTHER_ROOMS', 'NUMBER_OF_PARKING_SPACES', 'YEAR_BUILT',
+               'NUMBER_OF_FIREPLACES', 'NUMBER_OF_STORIES', 'DAYS_ON_MARKET'}
+FLAG_COLUMNS = {'HOA', 'POOL'}
+DATE_COLUMNS = {'SOLD_DATE'}
+
+# Column names used by the old text-only tables, mapped to their new names.
+LEGACY_COLUMNS = {
+    'ADDRESS': 'STREET',
+    'POSTOAL': 'POSTAL_CODE',
+    'POSTAL': 'POSTAL_CODE',
+}
+
+NUMBER_PATTERN = r'-?[0-9]*\.?[0-9]+'
+
+def to_number(value):
+    """'$1,250,000', '2.5', '0.4 mi' -> float; 'NULL', '—' or None -> None."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    m = re.search(NUMBER_PATTERN, str(value).replace(',', ''))
+    if not m:
+        return None
+    return float(m.group(0))
+
+def to_int(value):
+    number = to_number(value)
+    return None if number is None else int(number)
+
+def to_flag(value):
+    """'Yes' / 'Has Pool' -> 1, 'No' -> 0, missing -> None."""
+    if value is None or value == 'NULL':
+        return None
+    if isinstance(value, (int, float)):
+        return int(bool(value))
+    return 0 if str(value).strip().lower() in ('no', 'none', 'false', '0') else 1
+
+def to_date(value):
+    """'March-15-2023', 'MAR 15, 2023', '03/15/2023' or '2023-03-15' -> '2023-03-15'."""
+    value = to_text(value)
+    if value is None:
+        return None
+    for date_format in ('%Y-%m-%d', '%B-%d-%Y', '%b-%d-%Y', '%b %d, %Y', '%B %d, %Y', '%m/%d/%Y'):
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            pass
+    return None
+
+def to_text(value):
+    if value is None or value == 'NULL':
+        return None
+    return str(value).strip() or None
+
+def convert(column, value):
+    """Convert a scraped value to the storage type of column."""
+    if column in REAL_COLUMNS:
+        return to_number(value)
+    if column in INT_COLUMNS:
+        return to_int(value)
+    if column in FLAG_COLUMNS:
+        return to_flag(value)
+    if column in DATE_COLUMNS:
+        return to_date(value)
+    return to_text(value)
+
+def listing_path(url):
+    """Listings are keyed by url path, e.g. /TX/Austin/123-Main-St-78701/home/1."""
+    return urlparse(url).path or url
+
+def create_listing_tables(conn):
+    conn.execute(LISTING_DETAILS_DDL)
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(LISTING_DETAILS)')}
+    for column, column_type in ADDED_COLUMNS:
+        if column not in existing:
+            conn.execute('ALTER TABLE LISTING_DETAILS ADD COLUMN {} {}'.format(column, column_type))
+    conn.execute(LISTING_VERSION_DDL)
+    conn.execute("""
+        INSERT INTO LISTING_VERSION (VERSION)
+        SELECT COALESCE(MAX(ROW_VERSION), 0) FROM LISTING_DETAILS
+        WHERE NOT EXISTS (SELECT 1 FROM LISTING_VERSION)
+    """)
+    conn.execute(SCHOOLS_DDL)
+    conn.execute(LISTING_SCHOOLS_DDL)
+    for index in INDEXES:
+        conn.execute(index)
+    if 'ADDRESS_KEY' not in existing:
+        dedupe_listings(conn)
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS IDX_LISTING_ADDRESS_KEY ON LISTING_DETAILS (ADDRESS_KEY)')
+    conn.execute(LISTING_RTREE_DDL)
+    for trigger in LISTING_RTREE_TRIGGERS:
+        conn.execute(trigger)
+    # Pick up listings that got coordinates before the triggers existed.
+    conn.execute("""
+        INSERT OR IGNORE INTO LISTING_RTREE
+        SELECT LISTING_ID, LATITUDE, LATITUDE, LONGITUDE, LONGITUDE
+        FROM LISTING_DETAILS
+        WHERE LATITUDE IS NOT NULL AND LONGITUDE IS NOT NULL
+          AND LISTING_ID NOT IN (SELECT LISTING_ID FROM LISTING_RTREE)
+    """)
+    if not has_rollups(conn):
+        create_rollup_tables(conn)
+        rebuild_rollups(conn)
+
+def is_legacy(conn):
+    """True if LISTING_DETAILS still has the old untyped layout."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(LISTING_DETAILS)')]
+    return bool(columns) and 'LISTING_ID' not in columns
+
+def next_row_version(db):
+    return db.execute('UPDATE LISTING_VERSION SET VERSION = VERSION + 1 RETURNING VERSION').fetchone()[0]
+
+def upsert_listing(db, url, values):
+    """Insert or update the LISTING_DETAILS row for url with values,
+    a dict of column -> already converted value. Rows are matched on url
+    or, failing that, on the hashed canonical address, so the same home
+    reached through another url merges into the existing row. If the url's
+    row takes on the address of another row, the two rows are merged.
+    Values that are None never overwrite what is already stored, and
+    ROW_VERSION only moves when a stored value changes. Returns the
+    LISTING_ID.
+    """
+    address_columns = ['STREET', 'LOCALITY', 'REGION', 'POSTAL_CODE']
+    if any(values.get(c) for c in address_columns):
+        # Key the address the row will end up with: a page without, say, the
+        # postal code must not replace a ZIP-based key with a ZIP-less one.
+        stored = db.execute('SELECT {} FROM LISTING_DETAILS WHERE URL = ?'.format(', '.join(address_columns)),
+                            (url,)).fetchone() or [None] * len(address_columns)
+        address = [values.get(c) if values.get(c) is not None else value for c, value in zip(address_columns, stored)]
+        if address[0]:
+            values = dict(values, ADDRESS_KEY=address_key(*address))
+    columns = list(values)
+    changed = ' OR '.join('(excluded.{0} IS NOT NULL AND excluded.{0} IS NOT {0})'.format(c) for c in columns)
+    updates = ', '.join(['{0} = COALESCE(excluded.{0}, {0})'.format(c) for c in columns] +
+                        ['ROW_VERSION = CASE WHEN {} THEN excluded.ROW_VERSION ELSE ROW_VERSION END'.format(
+                            changed or 0)])
+    columns.append('ROW_VERSION')
+    values = dict(values, ROW_VERSION=next_row_version(db))
+    upsert = """
+        INSERT INTO LISTING_DETAILS (URL, {columns})
+        VALUES (?, {placeholders})
+        ON CONFLICT (URL) DO UPDATE SET {updates}
+        ON CONFLICT (ADDRESS_KEY) DO UPDATE SET {updates}
+        RETURNING LISTING_ID
+    """.format(columns=', '.join(columns),
+               placeholders=', '.join(['?'] * len(columns)),
+               updates=updates)
+    params = [url] + [values[c] for c in columns]
+    try:
+        return db.execute(upsert, params).fetchone()[0]
+    except sqlite3.IntegrityError as e:
+        if 'ADDRESS_KEY' not in str(e):
+            raise
+    # The url's row now has the address of another row (a corrected address,
+    # or a url Redfin moved to another home): fold it into that row, which
+    # the retried upsert then matches on ADDRESS_KEY.
+    url_id = db.execute('SELECT LISTING_ID FROM LISTING_DETAILS WHERE URL = ?', (url,)).fetchone()[0]
+    keyed_id = db.execute('SELECT LISTING_ID FROM LISTING_DETAILS WHERE ADDRESS_KEY = ?',
+                          (values['ADDRESS_KEY'],)).fetchone()[0]
+    merge_listing(db, url_id, keyed_id)
+    return db.execute(upsert, params).fetchone()[0]
+
+def merge_listing(db, merged_id, keep_id):
+    """Fold listing merged_id into keep_id the way dedupe_listings folds
+    duplicates: gaps in keep_id are filled from merged_id, school links move
+    over and merged_id is deleted.
+    """
+    columns = [row[1] for row in db.execute('PRAGMA table_info(LISTING_DETAILS)')
+               if row[1] not in ('LISTING_ID', 'URL', 'ADDRESS_KEY', 'ROW_VERSION')]
+    db.execute("""
+        UPDATE LISTING_DETAILS SET ROW_VERSION = ?, {}
+        WHERE LISTING_ID = ?
+    """.format(', '.join('{0} = COALESCE({0}, (SELECT {0} FROM LISTING_DETAILS WHERE LISTING_ID = ?))'.format(c)
+                         for c in columns)), [next_row_version(db)] + [merged_id] * len(columns) + [keep_id])
+    db.execute("""
+        INSERT OR IGNORE INTO LISTING_SCHOOLS (LISTING_ID, RANK, SCHOOL_ID, DISTANCE_MILES)
+        SELECT ?, RANK, SCHOOL_ID, DISTANCE_MILES FROM LISTING_SCHOOLS WHERE LISTING_ID = ?
+    """, (keep_id, merged_id))
+    for table in ('LISTING_SCHOOLS', 'LISTING_DETAILS'):
+        db.execute('DELETE FROM {} WHERE LISTING_ID = ?'.format(table), (merged_id,))
+    if has_rollups(db):
+        update_rollups(db, [merged_id])
+    print('Merged listing {} into {}'.format(merged_id, keep_id))
+
+def dedupe_listings(conn, rekey=False):
+    """Key every listing by its canonical address and fold duplicates into
+    the oldest row, in bulk inside SQLite. Gaps in the surviving row are
+    filled from the newest duplicate that has the value, and school links
+    move over with it. rekey recomputes every key, e.g. after the
+    canonicalization rules in addresses.py change.
+    """
+    conn.create_function('ADDRESS_KEY', 4, address_key, deterministic=True)
+    if rekey:
+        conn.execute('DROP INDEX IF EXISTS IDX_LISTING_ADDRESS_KEY')
+        conn.execute('UPDATE LISTING_DETAILS SET ADDRESS_KEY = NULL')
+    conn.execute("""
+        UPDATE LISTING_DETAILS SET ADDRESS_KEY = ADDRESS_KEY(STREET, LOCALITY, REGION, POSTAL_CODE)
+        WHERE ADDRESS_KEY IS NULL AND STREET IS NOT NULL
+    """)
+    conn.execute('DROP TABLE IF EXISTS temp.DUPLICATE_LISTINGS')
+    conn.execute("""
+        CREATE TEMP TABLE DUPLICATE_LISTINGS AS
+        SELECT LISTING_ID, MIN(LISTING_ID) OVER (PARTITION BY ADDRESS_KEY) AS KEEP_ID
+        FROM LISTING_DETAILS
+        WHERE ADDRESS_KEY IN (
+            SELECT ADDRESS_KEY FROM LISTING_DETAILS
+            WHERE ADDRESS_KEY IS NOT NULL
+            GROUP BY ADDRESS_KEY HAVING COUNT(*) > 1)
+    """)
+    duplicates = conn.execute('SELECT COUNT(*) - COUNT(DISTINCT KEEP_ID) FROM temp.DUPLICATE_LISTINGS').fetchone()[0]
+    if duplicates:
+        merged_ids = [row[0] for row in conn.execute('SELECT LISTING_ID FROM temp.DUPLICATE_LISTINGS')]
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(LISTING_DETAILS)')
+                   if row[1] not in ('LISTING_ID', 'URL', 'ADDRESS_KEY', 'ROW_VERSION')]
+        conn.execute("""
+            UPDATE LISTING_DETAILS SET ROW_VERSION = ?, {}
+            WHERE LISTING_ID IN (SELECT KEEP_ID FROM temp.DUPLICATE_LISTINGS)
+        """.format(', '.join("""
+            {0} = COALESCE({0}, (SELECT d.{0} FROM LISTING_DETAILS d
+                                 JOIN temp.DUPLICATE_LISTINGS x ON x.LISTING_ID = d.LISTING_ID
+                                 WHERE x.KEEP_ID = LISTING_DETAILS.LISTING_ID AND d.{0} IS NOT NULL
+                                 ORDER BY d.LISTING_ID DESC LIMIT 1))""".format(c) for c in columns)),
+            (next_row_version(conn),))
+        conn.execute("""
+            INSERT OR IGNORE INTO LISTING_SCHOOLS (LISTING_ID, RANK, SCHOOL_ID, DISTANCE_MILES)
+            SELECT x.KEEP_ID, s.RANK, s.SCHOOL_ID, s.DISTANCE_MILES
+            FROM LISTING_SCHOOLS s JOIN temp.DUPLICATE_LISTINGS x ON x.LISTING_ID = s.LISTING_ID
+            WHERE x.LISTING_ID != x.KEEP_ID
+        """)
+        for table in ('LISTING_SCHOOLS', 'LISTING_DETAILS'):
+            conn.execute("""
+                DELETE FROM {} WHERE LISTING_ID IN
+                    (SELECT LISTING_ID FROM temp.DUPLICATE_LISTINGS WHERE LISTING_ID != KEEP_ID)
+            """.format(table))
+        if has_rollups(conn):
+            update_rollups(conn, merged_ids)
+    conn.execute('DROP TABLE temp.DUPLICATE_LISTINGS')
+    print('Removed {} duplicate listings'.format(duplicates))
+    return duplicates
+
+def school_id(db, title, rating):
+    row = db.execute('SELECT SCHOOL_ID, RATING FROM SCHOOLS WHERE TITLE = ?', (title,)).fetchone()
+    if row is None:
+        return db.execute('INSERT INTO SCHOOLS (TITLE, RATING) VALUES (?, ?) RETURNING SCHOOL_ID',
+                          (title, rating)).fetchone()[0]
+    if rating is not None and rating != row[1]:
+        db.execute('UPDATE SCHOOLS SET RATING = ? WHERE SCHOOL_ID = ?', (rating, row[0]))
+        # School ratings are model features of every listing near the school.
+        db.execute("""
+            UPDATE LISTING_DETAILS SET ROW_VERSION = ?
+            WHERE LISTING_ID IN (SELECT LISTING_ID FROM LISTING_SCHOOLS WHERE SCHOOL_ID = ?)
+        """, (next_row_version(db), row[0]))
+    return row[0]
+
+def save_schools(db, listing_id, schools):
+    """schools is a list of (title, distance, rating) triples, nearest first.
+    The listing gets a new ROW_VERSION if its schools change.
+    """
+    links = 'SELECT RANK, SCHOOL_ID, DISTANCE_MILES FROM LISTING_SCHOOLS WHERE LISTING_ID = ? ORDER BY RANK'
+    before = db.execute(links, (listing_id,)).fetchall()
+    db.execute('DELETE FROM LISTING_SCHOOLS WHERE LISTING_ID = ?', (listing_id,))
+    for rank, (title, distance, rating) in enumerate(schools, 1):
+        title = to_text(title)
+        if title is None:
+            continue
+        db.execute("""
+            INSERT INTO LISTING_SCHOOLS (LISTING_ID, RANK, SCHOOL_ID, DISTANCE_MILES)
+            VALUES (?, ?, ?, ?)""", (listing_id, rank, school_id(db, title, to_int(rating)), to_number(distance)))
+    if db.execute(links, (listing_id,)).fetchall() != before:
+        db.execute('UPDATE LISTING_DETAILS SET ROW_VERSION = ? WHERE LISTING_ID = ?',
+                   (next_row_version(db), listing_id))
+
+def save_home_details(db, url, details, num_schools=3):
+    """Store one parse_home_info row: the scalar fields go to LISTING_DETAILS,
+    the school triples to SCHOOLS / LISTING_SCHOOLS.
+    """
+    head = details[:len(DETAIL_COLUMNS)]
+    school_values = details[len(DETAIL_COLUMNS):len(DETAIL_COLUMNS) + 3 * num_schools]
+    features = details[len(DETAIL_COLUMNS) + 3 * num_schools:]
+    values = {c: convert(c, v) for c, v in zip(DETAIL_COLUMNS + FEATURE_COLUMNS + STATUS_COLUMNS,
+                                               list(head) + list(features))}
+    listing_id = upsert_listing(db, listing_path(url), values)
+    schools = [school_values[i:i + 3] for i in range(0, len(school_values), 3)]
+    save_schools(db, listing_id, schools)
+    return listing_id
+
+def save_listing_summary(db, url, summary):
+    """Store one parse_addresses row (SUMMARY_COLUMNS order)."""
+    values = {c: convert(c, v) for c, v in zip(SUMMARY_COLUMNS, summary)}
+    return upsert_listing(db, listing_path(url), values)
+
+def migrate_listing_details(conn):
+    """Move a legacy LISTING_DETAILS table (either the ld+json summary layout
+    or the text detail layout with SCHOOLn_* columns) to the typed schema.
+    Duplicate urls collapse into one row, later rows winning field by field.
+    """
+    legacy_columns = [row[1] for row in conn.execute('PRAGMA table_info(LISTING_DETAILS)')]
+    print('Migrating LISTING_DETAILS ({} columns) to the typed schema'.format(len(legacy_columns)))
+    conn.execute('ALTER TABLE LISTING_DETAILS RENAME TO LISTING_DETAILS_LEGACY')
+    create_listing_tables(conn)
+
+    new_columns = set(DETAIL_COLUMNS + FEATURE_COLUMNS + SUMMARY_COLUMNS)
+    cursor = conn.execute('SELECT * FROM LISTING_DETAILS_LEGACY ORDER BY rowid')
+    migrated = 0
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        for row in rows:
+            record = dict(zip(legacy_columns, row))
+            url = record.get('URL')
+            if not url:
+                continue
+            values = {}
+            for column, value in record.items():
+                column = LEGACY_COLUMNS.get(column, column)
+                if column in new_columns:
+                    values[column] = convert(column, value)
+            listing_id = upsert_listing(conn, listing_path(url), values)
+            schools = [(record.get('SCHOOL{}_TITLE'.format(i)), record.get('SCHOOL{}_DISTANCE'.format(i)),
+                        record.get('SCHOOL{}_RATING'.format(i))) for i in range(1, 4)]
+            if any(title for title, _, _ in schools):
+                save_schools(conn, listing_id, schools)
+            migrated += 1
+    rebuild_rollups(conn)
+    conn.execute('DROP TABLE LISTING_DETAILS_LEGACY')
+    conn.commit()
+    # Reclaim the space the text columns used.
+    conn.execute('VACUUM')
+    count = conn.execute('SELECT COUNT(*) FROM LISTING_DETAILS').fetchone()[0]
+    print('Migrated {} legacy rows into {} listings'.format(migrated, count))
+
+def median_price_by_zip_year(conn, min_year=None):
+    """Median sale price per (postal code, year built), read in index
+    order from IDX_LISTING_POSTAL_YEAR_PRICE.
+    """
+    return conn.execute("""
+        WITH ranked AS (
+            SELECT POSTAL_CODE, YEAR_BUILT, PRICE,
+                   ROW_NUMBER() OVER (PARTITION BY POSTAL_CODE, YEAR_BUILT ORDER BY PRICE) AS N,
+                   COUNT(*) OVER (PARTITION BY POSTAL_CODE, YEAR_BUILT) AS TOTAL
+            FROM LISTING_DETAILS
+            WHERE PRICE IS NOT NULL AND YEAR_BUILT >= ?
+        )
+        SELECT POSTAL_CODE, YEAR_BUILT, AVG(PRICE)
+        FROM ranked
+        WHERE N IN ((TOTAL + 1) / 2, (TOTAL + 2) / 2)
+        GROUP BY POSTAL_CODE, YEAR_BUILT
+    """, (min_year or 0,)).fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate LISTING_DETAILS to the typed, normalized schema.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--dedupe', action='store_true', help='fold listings with the same address together')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if is_legacy(conn):
+        migrate_listing_details(conn)
+    elif args.dedupe:
+        dedupe_listings(conn, rekey=True)
+        create_listing_tables(conn)
+        conn.commit()
+    else:
+        create_listing_tables(conn)
+        conn.commit()
+        print('LISTING_DETAILS is already on the typed schema')
+    conn.close()
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import pandas as pd
+from collections import Counter, deque
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import redfin_urls
+from profiling import enable_profiling, aggregate_profiles
+from listing_schema import listing_path
+from redfin_urls import get_page_info, scrape_page, scrape_home_info, scrape_csv, needs_split, expand_partition, \
+    paginate, csv_exportable, save_url_info, save_home_info, save_csv_listings, load_fetch_cache, \
+    create_tables_if_not_exist
+
+# Add suburbs with --metro "Name=https://www.redfin.com/city/<id>/TX/<City>".
+METROS = {
+    'Austin': 'https://www.redfin.com/city/30818/TX/Austin',
+}
+
+SEARCH_FILTER = 'filter/include=forsale+mlsfsbo+construction+fsbo+sold-3yr'
+
+STAGE_FUNCTIONS = {
+    'partition': get_page_info,
+    'page': scrape_page,
+    'csv': scrape_csv,
+    'home': scrape_home_info,
+}
+
+# Share of a metro's requests each stage gets while it has work queued.
+# Later stages get more, so each metro turns its frontier into finished
+# homes instead of growing it, but partition and listing requests keep
+# going while a long queue of detail pages drains.
+STAGE_WEIGHTS = {'home': 4, 'page': 2, 'csv': 2, 'partition': 1}
+
+def create_progress_table():
+    conn = sqlite3.connect(redfin_urls.SQLITE_DB_PATH)
+    conn.execute('''CREATE TABLE IF NOT EXISTS METRO_PROGRESS
+             (
+             METRO          TEXT    NOT NULL,
+             STAGE          TEXT    NOT NULL,
+             COMPLETED      INT,
+             FAILED         INT,
+             PENDING        INT,
+             ELAPSED_SECONDS REAL,
+             PRIMARY KEY (METRO, STAGE));''')
+    conn.close()
+
+def listing_urls(info):
+    """Return the home urls found in the ld+json blocks stored by scrape_page."""
+    urls = []
+    for listing in json.loads(info):
+        if isinstance(listing, dict):
+            listing = [listing]
+        if not isinstance(listing, list):
+            continue
+        for details in listing:
+            if isinstance(details, dict) and ('url' in details) and ('address' in details):
+                urls.append(details['url'])
+    return urls
+
+
+class MetroCrawl:
+    """Partition, pagination (or CSV export) and detail stages for a single
+    metro, driven one request at a time by crawl_metros.
+    """
+
+    def __init__(self, name, city_url, proxies, fetch_cache, max_levels=6, use_csv=False):
+        self.name = name
+        self.base_url = '{}/{}'.format(city_url.rstrip('/'), SEARCH_FILTER)
+        self.proxies = proxies
+        self.fetch_cache = fetch_cache
+        self.max_levels = max_levels
+        self.use_csv = use_csv
+        self.site = '{0.scheme}://{0.netloc}'.format(urlparse(city_url))
+        self.pending = {stage: deque() for stage in STAGE_WEIGHTS}
+        self.credit = Counter()
+        self.pending['partition'].append((0, self.base_url))
+        self.seen_homes = set()
+        self.in_flight = 0
+        self.dispatched = 0
+        self.completed = Counter()
+        self.failed = Counter()
+        self.started = time.time()
+
+    def has_pending(self):
+        return any(self.pending.values())
+
+    def next_task(self):
+        """Smooth weighted round-robin over the stages with queued work:
+        every ready stage earns its weight in credit, the richest one goes
+        next and pays back the weights of all ready stages.
+        """
+        ready = [stage for stage in STAGE_WEIGHTS if self.pending[stage]]
+        if not ready:
+            return None
+        for stage in ready:
+            self.credit[stage] += STAGE_WEIGHTS[stage]
+        stage = max(ready, key=lambda stage: self.credit[stage])
+        self.credit[stage] -= sum(STAGE_WEIGHTS[stage] for stage in ready)
+        level, url = self.pending[stage].popleft()
+        self.in_flight += 1
+        self.dispatched += 1
+        return stage, level, url
+
+    def task_input(self, stage, url):
+        if stage == 'home':
+            return (url, self.proxies, self.fetch_cache.get(url))
+        return (url, self.proxies)
+
+    def handle(self, stage, level, url, result):
+        """Record a finished request and queue the requests it leads to."""
+        self.in_flight -= 1
+        if not result:
+            self.failed[stage] += 1
+            return
+        self.completed[stage] += 1
+
+        if stage == 'partition':
+            save_url_info([result])
+            sub_urls = []
+            if (needs_split(result) or level == 0) and level + 1 < self.max_levels:
+                sub_urls = expand_partition(url, self.base_url)
+            if sub_urls:
+                self.pending['partition'].extend((level + 1, sub_url) for sub_url in sub_urls)
+            elif self.use_csv and csv_exportable(result):
+                self.pending['csv'].append((level, url))
+            else:
+                self.pending['page'].extend((level, page_url) for page_url in paginate(*result))
+
+        elif stage == 'page':
+            page_url, info = result
+            with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+                db.execute("""
+                    INSERT INTO LISTINGS (URL, INFO)
+                    VALUES (?, ?)""", (page_url, info))
+            self.queue_homes(level, listing_urls(info))
+
+        elif stage == 'csv':
+            save_csv_listings([result])
+            self.queue_homes(level, [path for path, _ in result[1]])
+
+        else:
+            save_home_info([result])
+
+    def queue_homes(self, level, home_paths):
+        for home_url in home_paths:
+            # ld+json urls are not always relative, so key on the path the
+            # way the summary and CSV writers do.
+            home_url = self.site + listing_path(home_url)
+            if home_url not in self.seen_homes:
+                self.seen_homes.add(home_url)
+                self.pending['home'].append((level, home_url))
+
+    def progress(self):
+        """Return (stage, completed, failed, pending) for every stage."""
+        return [(stage, self.completed[stage], self.failed[stage], len(self.pending[stage]))
+                for stage in reversed(list(STAGE_WEIGHTS))]
+
+    def throughput(self):
+        """Requests finished per minute since the crawl started."""
+        elapsed = time.time() - self.started
+        return 60 * (sum(self.completed.values()) + sum(self.failed.values())) / max(elapsed, 1e-9)
+
+
+def report_progress(crawls):
+    elapsed = None
+    with sqlite3.connect(redfin_urls.SQLITE_DB_PATH) as db:
+        for crawl in crawls:
+            elapsed = time.time() - crawl.started
+            stages = crawl.progress()
+            print('{}: {} | {:.1f} requests/min, {} in flight'.format(
+                crawl.name,
+                ', '.join('{} {}/{} failed/{} pending'.format(*stage) for stage in stages),
+                crawl.throughput(), crawl.in_flight))
+            db.executemany("""
+                INSERT OR REPLACE INTO METRO_PROGRESS (METRO, STAGE, COMPLETED, FAILED, PENDING, ELAPSED_SECONDS)
+                VALUES (?, ?, ?, ?, ?, ?)""", [(crawl.name,) + stage + (elapsed,) for stage in stages])
+
+def crawl_metros(metros, proxies, max_in_flight=50, requests_per_second=None, report_every=100, use_csv=False):
+    """Crawl several metros at once under a shared request budget.
+    At most max_in_flight requests run at a time (optionally capped at
+    requests_per_second), and each free slot goes to the metro with the
+    fewest requests in flight, so a large city cannot starve its suburbs.
+    With use_csv each partition is enumerated through one CSV export request
+    instead of its search result pages, unless it holds more homes than an
+    export returns.
+    """
+    fetch_cache = load_fetch_cache()
+    crawls = [MetroCrawl(name, city_url, proxies, fetch_cache, use_csv=use_csv) for name, city_url in metros.items()]
+    min_interval = 1.0 / requests_per_second if requests_per_second else 0
+    last_dispatch = 0
+    finished = 0
+    futures = {}
+
+    with ProcessPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            while len(futures) < max_in_flight:
+                ready = [crawl for crawl in crawls if crawl.has_pending()]
+                if not ready:
+                    break
+                crawl = min(ready, key=lambda c: (c.in_flight, c.dispatched))
+                stage, level, url = crawl.next_task()
+                wait_seconds = last_dispatch + min_interval - time.time()
+                if wait_seconds > 0:
+                    time.sleep(wait_seconds)
+                last_dispatch = time.time()
+                future = executor.submit(STAGE_FUNCTIONS[stage], crawl.task_input(stage, url))
+                futures[future] = (crawl, stage, level, url)
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                crawl, stage, level, url = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print('Swallowing exception {} on url {}'.format(e, url))
+                    result = None
+                crawl.handle(stage, level, url, result)
+                finished += 1
+                if finished % report_every == 0:
+                    report_progress(crawls)
+
+    report_progress(crawls)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl several Redfin metros concurrently.')
+    parser.add_argument('--metro', action='append', default=[],
+                        help='Name=city url, e.g. "Austin=https://www.redfin.com/city/30818/TX/Austin"')
+    parser.add_argument('--max-in-flight', type=int, default=50)
+    parser.add_argument('--requests-per-second', type=float)
+    parser.add_argument('--proxy-csv', default='proxy.csv')
+    parser.add_argument('--profile', type=float, default=0, metavar='RATE',
+                        help='profile this fraction of the pages fetched by each stage, e.g. 0.01')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--csv', action='store_true',
+                        help='enumerate listings through the CSV export instead of the paginated search pages')
+    parser.add_argument('--csv-endpoint', help='CSV export url, e.g. a local stand-in for testing')
+    parser.add_argument('--direct', action='store_true', help='fetch without proxies, e.g. from a local stand-in')
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile, args.profile_dir)
+    if args.csv_endpoint:
+        os.environ['REDFIN_CSV_ENDPOINT'] = args.csv_endpoint
+
+    metros = dict(metro.split('=', 1) for metro in args.metro) if args.metro else METROS
+
+    create_tables_if_not_exist()
+    create_progress_table()
+
+    proxies = [] if args.direct else pd.read_csv(args.proxy_csv, encoding='utf-8').values.tolist()
+    crawl_metros(metros, proxies, args.max_in_flight, args.requests_per_second, use_csv=args.csv)
+    if args.profile:
+        aggregate_profiles(args.profile_dir)
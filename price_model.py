@@ -0,0 +1,116 @@
+import pickle
+import sqlite3
+import argparse
+import numpy as np
+from sklearn.linear_model import SGDRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from features import FEATURE_DIR, write_feature_matrix, load_feature_matrix, iter_batches
+
+MODEL_PATH = 'price_model.pkl'
+
+
+class PriceModel:
+    """A fitted estimator and the column statistics needed to apply it.
+    Predicts log price; price() undoes the log. corrections are extra
+    boosting stages fit later to the residuals on newer listings, added on
+    top of the estimator's prediction.
+    """
+
+    def __init__(self, estimator, columns, mean=None, std=None):
+        self.estimator = estimator
+        self.columns = columns
+        self.mean = None if mean is None else np.asarray(mean)
+        self.std = None if std is None else np.where(np.asarray(std) > 0, std, 1.0)
+        self.corrections = []
+
+    def transform(self, X):
+        """Mean-impute and standardize for the linear model; trees take X as is."""
+        if self.mean is None:
+            return X
+        X = np.where(np.isnan(X), self.mean, X)
+        return (X - self.mean) / self.std
+
+    def predict_batch(self, X):
+        prediction = self.estimator.predict(self.transform(X))
+        for correction in self.corrections:
+            prediction += correction.predict(X)
+        return prediction
+
+    def predict(self, X, batch_size=100000):
+        return np.concatenate([self.predict_batch(X[start:stop])
+                               for start, stop in iter_batches(len(X), batch_size)] or [np.empty(0)])
+
+    def price(self, X, batch_size=100000):
+        return np.exp(self.predict(X, batch_size))
+
+
+def train_sgd(X, y, meta, batch_size=10000, epochs=5, alpha=1e-4, seed=0):
+    """Linear model fit with partial_fit over mini-batches, so only one
+    batch of X is ever in memory.
+    """
+    model = PriceModel(SGDRegressor(alpha=alpha, random_state=seed), meta['columns'], meta['mean'], meta['std'])
+    for epoch in range(epochs):
+        for start, stop in iter_batches(len(X), batch_size, seed=seed + epoch):
+            model.estimator.partial_fit(model.transform(X[start:stop]), y[start:stop])
+    return model
+
+def train_hist_gbm(X, y, meta, validation_fraction=0.1, seed=0, **params):
+    """Histogram gradient boosting on the memory-mapped X. The estimator
+    bins X into a uint8 copy (one byte per value); the float64 matrix stays
+    on disk. The validation set for early stopping is the last
+    validation_fraction of the rows, a contiguous slice, because the
+    estimator's own split would copy X.
+    """
+    split = int(len(X) * (1 - validation_fraction)) if validation_fraction else len(X)
+    estimator = HistGradientBoostingRegressor(random_state=seed, **params)
+    if split < len(X):
+        estimator.set_params(early_stopping=True, validation_fraction=None)
+        estimator.fit(X[:split], y[:split], X_val=X[split:], y_val=y[split:])
+    else:
+        estimator.set_params(early_stopping=False)
+        estimator.fit(X, y)
+    return PriceModel(estimator, meta['columns'])
+
+def evaluate(model, X, y, batch_size=100000):
+    """Mean absolute error of the log price and median absolute percentage
+    error of the price, computed batch by batch.
+    """
+    errors = np.concatenate([model.predict(X[start:stop]) - y[start:stop]
+                             for start, stop in iter_batches(len(X), batch_size)] or [np.empty(0)])
+    if not len(errors):
+        return {'LOG_MAE': None, 'MEDIAN_APE': None}
+    return {'LOG_MAE': float(np.mean(np.abs(errors))),
+            'MEDIAN_APE': float(np.median(np.abs(np.expm1(errors))))}
+
+def save_model(model, path=MODEL_PATH):
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
+
+def load_model(path=MODEL_PATH):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the home price model on the memory-mapped feature matrix.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--feature-dir', default=FEATURE_DIR)
+    parser.add_argument('--refresh-features', action='store_true', help='rewrite the feature matrix first')
+    parser.add_argument('--model', choices=['hgb', 'sgd'], default='hgb')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--output', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    if args.refresh_features:
+        conn = sqlite3.connect(args.db)
+        write_feature_matrix(conn, args.feature_dir)
+        conn.close()
+    X, y, _, meta = load_feature_matrix(args.feature_dir)
+    if args.model == 'sgd':
+        model = train_sgd(X, y, meta, args.batch_size, args.epochs)
+    else:
+        model = train_hist_gbm(X, y, meta)
+    print('Trained on {} listings: {}'.format(len(X), evaluate(model, X, y)))
+    save_model(model, args.output)
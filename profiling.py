@@ -0,0 +1,110 @@
+import os
+import sys
+import glob
+import time
+import pstats
+import random
+import cProfile
+import functools
+import threading
+from collections import Counter
+
+# Read from the environment so pool workers pick the settings up whether
+# they are forked or spawned.
+PROFILE_RATE = float(os.environ.get('REDFIN_PROFILE_RATE', 0))
+PROFILE_DIR = os.environ.get('REDFIN_PROFILE_DIR', 'profiles')
+SAMPLE_INTERVAL = 0.005
+
+def enable_profiling(rate, output_dir='profiles'):
+    """Profile a random rate (0-1) of the calls to every @profiled stage,
+    in this process and in any worker process started after this call.
+    Per-call files an earlier run left in output_dir are removed, so that
+    aggregate_profiles only merges this run's calls.
+    """
+    global PROFILE_RATE, PROFILE_DIR
+    PROFILE_RATE, PROFILE_DIR = rate, output_dir
+    for pattern in ('*.prof', '*.collapsed'):
+        for path in glob.glob(os.path.join(output_dir, '*', pattern)):
+            os.remove(path)
+    os.environ['REDFIN_PROFILE_RATE'] = str(rate)
+    os.environ['REDFIN_PROFILE_DIR'] = output_dir
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+def sample_stacks(thread_id, root, stop, stacks):
+    """Record the stack of thread_id below the root frame every
+    SAMPLE_INTERVAL until stop is set.
+    """
+    while not stop.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None and frame is not root:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stacks[';'.join(reversed(names))] += 1
+
+def run_profiled(stage, func, args, kwargs):
+    stage_dir = os.path.join(PROFILE_DIR, stage)
+    os.makedirs(stage_dir, exist_ok=True)
+    stacks, stop = Counter(), threading.Event()
+    sampler = threading.Thread(target=sample_stacks, daemon=True,
+                               args=(threading.get_ident(), sys._getframe(), stop, stacks))
+    profile = cProfile.Profile()
+    sampler.start()
+    profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        stop.set()
+        sampler.join()
+        name = os.path.join(stage_dir, '{}-{}'.format(os.getpid(), time.time_ns()))
+        profile.dump_stats(name + '.prof')
+        with open(name + '.collapsed', 'w') as f:
+            for stack, count in stacks.items():
+                f.write('{} {}\n'.format(stack, count))
+
+def profiled(stage):
+    """Decorator that runs a sampled fraction of calls under cProfile plus
+    a stack sampler, writing one .prof and one .collapsed file per call into
+    PROFILE_DIR/<stage>. When profiling is off the only cost is one
+    comparison per call.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILE_RATE <= 0 or random.random() >= PROFILE_RATE:
+                return func(*args, **kwargs)
+            return run_profiled(stage, func, args, kwargs)
+        return wrapper
+    return decorator
+
+def aggregate_profiles(output_dir=None, top=25):
+    """Merge the per-call files of every stage into <stage>.pstats and
+    <stage>.collapsed (flamegraph.pl / speedscope input) in output_dir,
+    and print the top functions by cumulative time for each stage.
+    """
+    output_dir = output_dir or PROFILE_DIR
+    for stage_dir in sorted(glob.glob(os.path.join(output_dir, '*', ''))):
+        stage = os.path.basename(os.path.dirname(stage_dir))
+        prof_files = glob.glob(os.path.join(stage_dir, '*.prof'))
+        if not prof_files:
+            continue
+        stats = pstats.Stats(*prof_files)
+        stats.dump_stats(os.path.join(output_dir, stage + '.pstats'))
+
+        stacks = Counter()
+        for collapsed_file in glob.glob(os.path.join(stage_dir, '*.collapsed')):
+            with open(collapsed_file) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    stacks['{};{}'.format(stage, stack)] += int(count)
+        with open(os.path.join(output_dir, stage + '.collapsed'), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        print('Stage {}: {} sampled calls'.format(stage, len(prof_files)))
+        stats.sort_stats('cumulative').print_stats(top)
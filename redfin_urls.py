@@ -1,5 +1,8 @@
 import re
+import os
+import csv
 import json
+import hashlib
 import random
 import requests
 import logging
@@ -9,11 +12,68 @@ import pandas as pd
 import argparse
 from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
+from lxml import etree
 import sqlite3
 import fake_useragent
 from itertools import cycle
-
-from filters import apply_filters
+from urllib.parse import urlencode, urlparse
+from collections import Counter
+
+from filters import apply_filters, parse_filter_params
+from profiling import profiled, enable_profiling, aggregate_profiles
+from listing_schema import create_listing_tables, is_legacy, migrate_listing_details, \
+    save_home_details, save_listing_summary, upsert_listing, listing_path, convert
+from rollups import update_rollups
+from fetch_policy import FetchError, NetworkError, BlockedError, ParseError, RETRY_POLICY, \
+    classify_response, retry_delay, breaker_for
+
+try:
+    import brotli
+    ACCEPT_ENCODING = 'br, gzip, deflate'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+SQLITE_DB_PATH = 'redfin-scraper-data.db'
+
+HEADER = {
+    'User-agent': 'Chrome',
+    'Accept-Encoding': ACCEPT_ENCODING,
+}
+
+CITY_PATH_PATTERN = r'.*/city/[0-9]+/([A-Z]{2})/([^/]+)/.*'
+
+NUM_SCHOOLS = 3
+
+# Listing detail entries, in the order parse_home_info returns them.
+HOME_FEATURES = ['# of Dining Rooms', '# of Living Rooms', 'Other Rooms', 'Dining Room Description',
+                 'Kitchen Features', 'Kitchen Appliances', 'School District', '# of Parking Spaces',
+                 'Parking Features', 'Year Built', '# of Fireplaces', 'Has HOA', 'HOA Dues',
+                 'Has Pool', 'Pool Features', '# of Stories', 'Area Amenities']
+
+# Status banner of a sold home's page, e.g. "SOLD ON MAR 15, 2023".
+SOLD_BANNER_PATTERN = r'SOLD (?:ON |BY REDFIN )?([A-Z]{3} [0-9]{1,2}, [0-9]{4})'
+
+# Bulk export behind the search page's "Download All" link. Override with
+# REDFIN_CSV_ENDPOINT (e.g. a local stand-in) or --csv-endpoint.
+CSV_ENDPOINT = 'https://www.redfin.com/stingray/api/gis-csv'
+# The export returns at most this many homes. url_partition leaves can hold
+# up to 18 pages of 20, so the bigger ones are paged through instead.
+CSV_MAX_HOMES = 350
+
+SOLD_WITHIN_DAYS = {'sold-1wk': 7, 'sold-1mo': 30, 'sold-3mo': 90, 'sold-6mo': 180,
+                    'sold-1yr': 365, 'sold-2yr': 730, 'sold-3yr': 1095, 'sold-5yr': 1825}
+# Export sale flags for the for-sale include= options of a filter url.
+SALE_FLAGS = {'forsale': '1,2', 'mlsfsbo': '3', 'construction': '5,6', 'fsbo': '7'}
+# parse_filter_params key -> export query parameter.
+CSV_FILTERS = {'min_price': 'min_price', 'max_price': 'max_price',
+               'min_sqft': 'min_listing_approx_size', 'max_sqft': 'max_listing_approx_size',
+               'min_year': 'min_year_built', 'max_year': 'max_year_built'}
+# Export header -> LISTING_DETAILS column.
+CSV_COLUMNS = {'ADDRESS': 'STREET', 'CITY': 'LOCALITY', 'STATE OR PROVINCE': 'REGION',
+               'ZIP OR POSTAL CODE': 'POSTAL_CODE', 'PROPERTY TYPE': 'TYPE', 'PRICE': 'PRICE',
+               'BEDS': 'NUMBER_OF_BEDS', 'BATHS': 'NUMBER_OF_BATHS', 'SQUARE FEET': 'SQFT',
+               'YEAR BUILT': 'YEAR_BUILT', 'DAYS ON MARKET': 'DAYS_ON_MARKET', 'HOA/MONTH': 'HOA_DUES',
+               'SOLD DATE': 'SOLD_DATE', 'LATITUDE': 'LATITUDE', 'LONGITUDE': 'LONGITUDE'}
 
 def create_tables_if_not_exist():
     conn = sqlite3.connect(SQLITE_DB_PATH)
@@ -27,59 +87,16 @@ def create_tables_if_not_exist():
              (
              URL            TEXT    NOT NULL,
              INFO           TEXT);''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS LISTING_DETAILS
+    if is_legacy(conn):
+        migrate_listing_details(conn)
+    create_listing_tables(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS FETCH_CACHE
              (
-             URL            TEXT    NOT NULL,
-             NUMBER_OF_ROOMS INT,
-             NAME           TEXT,
-             COUNTRY        TEXT,
-             REGION         TEXT,
-             LOCALITY       TEXT,
-             STREET         TEXT,
-             POSTOAL        TEXT,
-             TYPE           TEXT,
-             PRICE          REAL
-             );''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS LISTING_DETAILS
-            (
-            URL                       TEXT    NOT NULL,
-            ADDRESS                   TEXT    NOT NULL,
-            LOCALITY                  TEXT    NOT NULL,
-            REGION                    TEXT    NOT NULL,
-            POSTAL CODE               TEXT    NOT NULL,
-            PRICE                     TEXT    NOT NULL,
-            NUMBER_OF_BEDS            INT,
-            NUMBER_OF_BATHS           INT,
-            WALK_SCORE                INT,
-            TRANSIT_SCORE             INT,
-            BIKE_SCORE                INT,
-            SCHOOL1_TITLE             TEXT,
-            SCHOOL1_DISTANCE          TEXT,
-            SCHOOL1_RATING            INT,
-            SCHOOL2_TITLE             TEXT,
-            SCHOOL2_DISTANCE          TEXT,
-            SCHOOL2_RATING            INT,
-            SCHOOL3_TITLE             TEXT,
-            SCHOOL3_DISTANCE          TEXT,
-            SCHOOL3_RATING            INT,
-            NUMBER_OF_DINING_ROOMS    INT,
-            NUMBER_OF_LIVING_ROOMS    INT,
-            NUMBER_OF_OTHER_ROOMS     INT,
-            DINING_ROOM_DESCRIPTION   TEXT,
-            KITCHEN_FEATURES          TEXT,
-            KITCHEN_APPLIANCES        TEXT,
-            SCHOOL_DISTRICT           TEXT,
-            NUMBER_OF_PARKING_SPACES  INT,
-            PARKING_FEATURES          TEXT,
-            YEAR_BUILT                TEXT,
-            NUMBER_OF_FIREPLACES      INT,
-            HOA                       TEXT,
-            HOA_DUES                  TEXT,
-            POOL                      TEXT,
-            POOL_FEATURES             TEXT,
-            NUMBER_OF_STORIES         INT,
-            AREA_AMENITIES            TEXT
-            );''')
+             URL            TEXT    PRIMARY KEY,
+             ETAG           TEXT,
+             LAST_MODIFIED  TEXT,
+             CONTENT_HASH   TEXT);''')
+    conn.commit()
     conn.close()
 
 def construct_proxy(ip_addr, port):
@@ -125,9 +142,110 @@ def find_successful_proxies(proxies):
 
     return successful_proxies
 
+def load_fetch_cache(urls=None):
+    """Return a dict of url -> (etag, last_modified, content_hash)
+    for every detail page fetched on a previous run, or only for urls.
+    """
+    query = """
+            SELECT URL, ETAG, LAST_MODIFIED, CONTENT_HASH
+            FROM FETCH_CACHE
+        """
+    with sqlite3.connect(SQLITE_DB_PATH) as db:
+        if urls is None:
+            return {row[0]: tuple(row[1:]) for row in db.execute(query)}
+        urls = list(urls)
+        fetch_cache = {}
+        for i in range(0, len(urls), 500):
+            batch = urls[i:i + 500]
+            cursor = db.execute(query + 'WHERE URL IN ({})'.format(', '.join(['?'] * len(batch))), batch)
+            fetch_cache.update((row[0], tuple(row[1:])) for row in cursor)
+        return fetch_cache
+
+def conditional_header(header, validators):
+    """Copy of header with If-None-Match / If-Modified-Since set from
+    the validators stored for a url, so unchanged pages come back as 304.
+    """
+    header = dict(header)
+    if validators:
+        etag, last_modified, _ = validators
+        if etag:
+            header['If-None-Match'] = etag
+        if last_modified:
+            header['If-Modified-Since'] = last_modified
+    return header
+
+def fetch(url, proxies, header=None, stream=False):
+    """GET url through a rotating pool of proxies.
+    Failures are classified (see fetch_policy) and each class is retried
+    according to its own policy; blocked responses also count against the
+    host's circuit breaker. Raises the last FetchError once the policy for
+    its class runs out. With stream=True the body is left unread, see
+    iter_closed_elements. An empty proxy list connects directly, e.g. to
+    a local stand-in.
+    """
+    header = header or HEADER
+    random.shuffle(proxies)
+    proxy_pool = cycle(proxies or [None])
+    breaker = breaker_for(url)
+    attempts = Counter()
+    while True:
+        breaker.wait()
+        proxy_element = next(proxy_pool)
+        proxy = proxy_element and construct_proxy(proxy_element[1], proxy_element[2])
+        try:
+            resp = requests.get(url, headers=header, proxies=proxy, timeout=30, stream=stream)
+            print('Got {} status code.'.format(resp.status_code))
+            error = classify_response(resp)
+            if error is not None:
+                resp.close()
+        except requests.RequestException as e:
+            error = NetworkError('{} via proxy {}'.format(e, proxy))
+        if error is None:
+            breaker.record_success()
+            return resp
+
+        if isinstance(error, BlockedError):
+            breaker.record_block()
+        error_class = type(error)
+        attempts[error_class] += 1
+        max_attempts = RETRY_POLICY[error_class][0] or len(proxies) + 1
+        print('failed for url {}, proxy {}: {}'.format(url, proxy, error))
+        if attempts[error_class] >= max_attempts:
+            raise error
+        time.sleep(retry_delay(error_class, attempts[error_class]))
+
+def iter_closed_elements(resp, chunk_size=16384):
+    """Feed a streamed response into lxml's incremental HTML parser and
+    yield each element as soon as its end tag has been parsed.
+    Breaking out of the loop closes the connection, so the rest of the
+    page is never downloaded.
+    """
+    parser = etree.HTMLPullParser(events=('end',))
+    try:
+        for chunk in resp.iter_content(chunk_size):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                yield element
+        parser.close()
+        for _, element in parser.read_events():
+            yield element
+    finally:
+        resp.close()
+
+def has_class(element, class_name):
+    return class_name in (element.get('class') or '').split()
+
+def log_transfer(stage, url, resp):
+    # raw.tell() counts bytes off the wire, i.e. before decompression.
+    print('{}: read {} of {} bytes for {}'.format(
+        stage, resp.raw.tell(), resp.headers.get('Content-Length', 'unknown'), url))
+
+@profiled('partition')
 def get_page_info(url_and_proxies):
     """
     Return property count, page count and total properties under a given URL.
+    The page is streamed and the download stops once the summary and the
+    pagination links have been parsed.
 
     :param url_and_proxies: list, refers to single url from Redfin.com with filters applied
         and list of ip:port pairs for proxies scraping from openproxy.space
@@ -136,56 +254,90 @@ def get_page_info(url_and_proxies):
     url, proxies = url_and_proxies
     # LOGGER.info('Requesting {} url'.format(url))
     print('Requesting {} url'.format(url))
-    random.shuffle(proxies)
-    proxy_pool = cycle(proxies)
 
     time.sleep(random.random() * 10)
-    session = requests.Session()
     total_properties, num_pages, properties_per_page = None, None, None
-    count = 0
-    num_proxies = len(proxies)
-    while count <= num_proxies:
-        try:
-            proxy_element = next(proxy_pool)
-            proxy = construct_proxy(proxy_element[1], proxy_element[2])
-            # LOGGER.info('Using {} proxy'.format(proxy))
-            print('Using {} proxy'.format(proxy))
-            resp = session.get(url, headers=HEADER, proxies=proxy, timeout=30)
-            resp.raise_for_status()
-            # LOGGER.info('Got {} status code.'.format(resp.status_code))
-            print('Got {} status code.'.format(resp.status_code))
+    try:
+        resp = fetch(url, proxies, stream=True)
+    except FetchError as e:
+        # LOGGER.exception('Swallowing exception {} on url {}'.format(e, url))
+        print('Swallowing exception {} on url {}'.format(e, url))
+        return (url, total_properties, num_pages, properties_per_page)
+
+    page_description, pages, paging_div = None, [], None
+    try:
+        for element in iter_closed_elements(resp):
+            if element.tag == 'div' and has_class(element, 'homes') and has_class(element, 'summary'):
+                page_description = ''.join(element.itertext())
+                if 'of' not in page_description:
+                    # Everything fits on one page, no pagination links to wait for.
+                    break
+            elif element.tag == 'a' and has_class(element, 'goToPage'):
+                pages.append(''.join(element.itertext()).strip())
+                if paging_div is None:
+                    paging_div = next(element.iterancestors('div'), None)
+            elif element is paging_div and page_description is not None:
+                break
+    except (requests.RequestException, etree.LxmlError) as e:
+        print('Swallowing exception {} on url {}'.format(e, url))
+        return (url, total_properties, num_pages, properties_per_page)
+    log_transfer('partition', url, resp)
+
+    if not page_description:
+        # The page has nothing!
+        return(url, 0, 0, 20)
+    if 'of' in page_description:
+        property_cnt_pattern = r'Showing ([0-9]+) of ([0-9]+) .*'
+        m = re.match(property_cnt_pattern, page_description)
+        if m:
+            properties_per_page = int(m.group(1))
+            total_properties = int(m.group(2))
+        num_pages = max([int(page) for page in pages if page.isdigit()], default=None)
+    else:
+        property_cnt_pattern = r'Showing ([0-9]+) .*'
+        m = re.match(property_cnt_pattern, page_description)
+        if m:
+            properties_per_page = int(m.group(1))
+        num_pages = 1
 
-            if resp.status_code == 200:
-                bf = BeautifulSoup(resp.text, 'lxml')
-                page_description_div = bf.find('div', {'class': 'homes summary'})
-                if not page_description_div:
-                    # The page has nothing!
-                    return(url, 0, 0, 20)
-                page_description = page_description_div.get_text()
-                if 'of' in page_description:
-                    property_cnt_pattern = r'Showing ([0-9]+) of ([0-9]+) .*'
-                    m = re.match(property_cnt_pattern, page_description)
-                    if m:
-                        properties_per_page = int(m.group(1))
-                        total_properties = int(m.group(2))
-                    pages = [int(x.get_text()) for x in bf.find_all('a', {'class': "goToPage"})]
-                    num_pages = max(pages)
-                else:
-                    property_cnt_pattern = r'Showing ([0-9]+) .*'
-                    m = re.match(property_cnt_pattern, page_description)
-                    if m:
-                        properties_per_page = int(m.group(1))
-                    num_pages = 1
-
-                return (url, total_properties, num_pages, properties_per_page)
-
-        except Exception as e:
-            # LOGGER.exception('Swallowing exception {} on url {}'.format(e, url))
-            print('Swallowing exception {} on url {}'.format(e, url))
-            count += 1
-            continue
     return (url, total_properties, num_pages, properties_per_page)
 
+def needs_split(result):
+    """True when a get_page_info result holds more properties than
+    its pages can show, so the url has to be filtered further.
+    """
+    return bool(result[1] and result[2] and result[3] and result[1] > result[2] * result[3])
+
+def expand_partition(url, base_url):
+    """Return the finer-grained filter urls for url, or an empty
+    list if it cannot be split any further.
+    """
+    expanded_urls = apply_filters(url, base_url)
+    if len(expanded_urls) == 1 and expanded_urls[0] == url:
+        # LOGGER.info('Cannot further split {}'.format(url))
+        print("Cannot further split {}".format(url))
+        return []
+    return expanded_urls
+
+def save_url_info(scraper_results, db=None):
+    """Write get_page_info results to the URLS table, on db inside the
+    caller's transaction when given, otherwise in a transaction of its own.
+    """
+    if db is None:
+        with sqlite3.connect(SQLITE_DB_PATH) as db:
+            return save_url_info(scraper_results, db)
+    values = []
+    for result in scraper_results:
+        to_nulls = [x if x else 'NULL' for x in result]
+        values.append("('{}', {}, {}, {})".format(*to_nulls))
+    if not values:
+        return
+    cursor = db.cursor()
+    cursor.execute("""
+        INSERT INTO URLS (URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES)
+        VALUES {};
+    """.format(','.join(values)))
+
 def url_partition(base_url, proxies, max_levels=6, LOGGER = None):
     """Partition the listings for a given url into multiple sub-urls,
     such that each url contains at most 20 properties.
@@ -215,30 +367,16 @@ def url_partition(base_url, proxies, max_levels=6, LOGGER = None):
         print("Values from search criteria, Step {}:\n {}".format(num_levels + 1, values))
 
 
-        with sqlite3.connect(SQLITE_DB_PATH) as db:
-            print('stage {} saving to db!'.format(num_levels))
-            # LOGGER.info('stage {} saving to db!'.format(num_levels))
-            values = []
-            for result in scraper_results:
-                to_nulls = [x if x else 'NULL' for x in result]
-                values.append("('{}', {}, {}, {})".format(*to_nulls))
-            cursor = db.cursor()
-            cursor.execute("""
-                INSERT INTO URLS (URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES)
-                VALUES {};
-            """.format(','.join(values)))
+        print('stage {} saving to db!'.format(num_levels))
+        # LOGGER.info('stage {} saving to db!'.format(num_levels))
+        save_url_info(scraper_results)
 
         # LOGGER.info('Writing to value list {} results'.format(len(scraper_results)))
         print("Writing to value list {} results".format(len(scraper_results)))
         new_urls = []
         for result in scraper_results:
-            if (result[1] and result[2] and result[3] and result[1] > result[2] * result[3]) or (num_levels == 0):
-                expanded_urls = apply_filters(result[0], base_url)
-                if len(expanded_urls) == 1 and expanded_urls[0] == result[0]:
-                    # LOGGER.info('Cannot further split {}'.format(result[0]))
-                    print("Cannot further split {}".format(result[0]))
-                else:
-                    new_urls.extend(expanded_urls)
+            if needs_split(result) or (num_levels == 0):
+                new_urls.extend(expand_partition(result[0], base_url))
             else:
                 partitioned_urls.append(result)
         # LOGGER.info('stage {}: running for {} urls. We already captured {} urls'.format(
@@ -250,6 +388,20 @@ def url_partition(base_url, proxies, max_levels=6, LOGGER = None):
         time.sleep(random.randint(2, 5))
     # return partitioned_urls
 
+def paginate(url, num_properties, num_pages, per_page_properties):
+    """Return the paginated urls for a single URLS row."""
+    if num_properties == 0:
+        return []
+    if not num_pages:
+        return [url]
+    elif (not num_properties) and int(num_pages) == 1 and per_page_properties:
+        return ['{},sort=lo-price/page-1'.format(url)]
+    elif num_properties <= num_pages * per_page_properties:
+        # Build per page urls; a partition that exactly fills its pages is
+        # not split by needs_split either.
+        return ['{},sort=lo-price/page-{}'.format(url, p) for p in range(1, num_pages + 1)]
+    return []
+
 def get_paginated_urls(prefix):
     # Return a set of paginated urls with at most 20 properties each.
     paginated_urls = []
@@ -260,209 +412,367 @@ def get_paginated_urls(prefix):
         """)
         seen_urls = set()
         for row in cursor:
-            url, num_properties, num_pages, per_page_properties = row
+            url = row[0]
             if prefix and (prefix not in url):
                 continue
             if url in seen_urls:
                 continue
-            if num_properties == 0:
-                continue
-            urls = []
-            # print(num_properties, num_pages, per_page_properties, url)
-            if not num_pages:
-                urls = [url]
-            elif (not num_properties) and int(num_pages) == 1 and per_page_properties:
-                urls = ['{},sort=lo-price/page-1'.format(url)]
-            elif num_properties < num_pages * per_page_properties:
-                # Build per page urls.
-                # print('num pages {}'.format(num_pages))
-                urls = ['{},sort=lo-price/page-{}'.format(url, p) for p in range(1, num_pages + 1)]
-            paginated_urls.extend(urls)
+            paginated_urls.extend(paginate(*row))
     return list(set(paginated_urls))
 
+def home_path_prefix(url):
+    """Return the '/TX/Austin/' style path that home urls share
+    for the city a search url belongs to.
+    """
+    m = re.match(CITY_PATH_PATTERN, url)
+    if not m:
+        return '/'
+    return '/{}/{}/'.format(*m.groups())
+
 def partition_into_individual_homes(paginated_url_and_proxies):
     """Function to convert paginated urls to home-specific urls.
     Currently not in use.
     """
 
-    url, proxies = url_and_proxies
-    random.shuffle(proxies)
-    proxy_pool = cycle(proxies)
+    url, proxies = paginated_url_and_proxies
+    prefix = home_path_prefix(url)
     time.sleep(random.random() * 16)
-    num_proxies = len(proxies)
-    count = 0
     url_list = []
 
-    while count <= len(proxies):
-        try:
-            proxy_element = next(proxy_pool)
-            proxy = construct_proxy(proxy_element[1], proxy_element[2])
-            session = requests.Session()
-            resp = session.get(url, headers=HEADER, proxies = proxy, timeout=30)
-            resp.raise_for_status()
-            print('Got {} status code.'.format(resp.status_code))
-
-            if resp.status_code == 200:
-                bf = BeautifulSoup(resp.text, 'lxml')
-                for link in bf.find_all('a'):
-                    if type(link.get('href')) is str and link.get('href').startswith('/TX/Austin/'):
-                        url_list.append(link.get('href'))
-                return url_list
-        except Exception as e:
-            print('Swallowing exception {} on url {}'.format(e, url))
-            count += 1
-            continue
-
+    try:
+        resp = fetch(url, proxies)
+    except FetchError as e:
+        print('Swallowing exception {} on url {}'.format(e, url))
+        return None
+
+    bf = BeautifulSoup(resp.text, 'lxml')
+    for link in bf.find_all('a'):
+        if type(link.get('href')) is str and link.get('href').startswith(prefix):
+            url_list.append(link.get('href'))
+    return url_list
+
+def text_or_none(parent, *args, **kwargs):
+    """Stripped text of parent.find(*args, **kwargs), or None when either
+    the parent or the element is missing from the page.
+    """
+    if parent is None:
+        return None
+    element = parent.find(*args, **kwargs)
+    if element is None:
+        return None
+    return element.text.strip()
+
+def parse_home_info(html):
+    """Pull the LISTING_DETAILS fields out of a home page, in column order,
+    ending with the sold date of a sold home. Only the street address is
+    required; any other missing field is None.
+    """
+    bf = BeautifulSoup(html, 'lxml')
+    # pull basic home information
+    address_div = bf.find('h1', {'class': 'address inline-block'})
+    address = text_or_none(address_div, 'span', {'class': 'street-address'})
+    if address is None:
+        raise ParseError('no street address on page')
+    locality = text_or_none(address_div, 'span', {'class': 'locality'})
+    region = text_or_none(address_div, 'span', {'class': 'region'})
+    postal = text_or_none(address_div, 'span', {'class': 'postal-code'})
+    redfin_price_description_div = bf.find('div', {'class': 'info-block price'})
+    redfin_estimate = text_or_none(redfin_price_description_div, 'div', {'class': 'statsValue'})
+    beds_div = bf.find('div', {'class': 'info-block', 'data-rf-test-id': 'abp-beds'})
+    num_beds = text_or_none(beds_div, 'div', {'class': 'statsValue'})
+    baths_div = bf.find('div', {'class': 'info-block', 'data-rf-test-id': 'abp-baths'})
+    num_baths = text_or_none(baths_div, 'div', {'class': 'statsValue'})
+    running_list = [address, locality, region, postal, redfin_estimate, num_beds, num_baths]
+    # find transportation scores for home
+    for score in ('walkscore', 'transitscore', 'bikescore'):
+        score_div = bf.find('div', {'class': 'transport-icon-and-percentage {}'.format(score)})
+        running_list.append(text_or_none(score_div, 'span', {'class': re.compile('value*')}))
+    # find nearby school data for home, padded out to NUM_SCHOOLS entries
+    schools = []
+    for element in bf.find_all('tr', {'class': 'schools-table-row'})[:NUM_SCHOOLS]:
+        schools.extend((text_or_none(element, 'div', {'class': 'school-title'}),
+                        text_or_none(element, 'div', {'class': 'value'}),
+                        text_or_none(element, 'span', {'class': 'rating-num'})))
+    schools.extend([None] * (3 * NUM_SCHOOLS - len(schools)))
+    running_list.extend(schools)
+    # pull data from the listing details container
+    entries = [element.text for element in bf.find_all('span', {'class': 'entryItemContent'})]
+    for feature in HOME_FEATURES:
+        value = None
+        for entry in entries:
+            if ':' in entry:
+                if feature in entry.split(':')[0]:
+                    value = entry.split(':')[1].strip()
+                    break
+            elif feature in entry:
+                value = entry
+                break
+        running_list.append(value)
+    # The sale date, so that sold prices can be told from asking prices.
+    banner = bf.find('div', {'class': re.compile('ListingStatusBanner')})
+    sold = banner and re.search(SOLD_BANNER_PATTERN, banner.get_text(' '), re.IGNORECASE)
+    running_list.append(sold.group(1) if sold else None)
+    return running_list
+
+@profiled('detail')
 def scrape_home_info(url_and_proxies):
     """Function to pull specific information from a given home listing
     on redfin.com. 
+    An optional third element holds the (etag, last_modified, content_hash)
+    validators from the previous fetch. Returns (url, validators, details),
+    where details is None when the page has not changed since then.
     """
-    url, proxies = url_and_proxies
+    url, proxies = url_and_proxies[:2]
+    validators = url_and_proxies[2] if len(url_and_proxies) > 2 else None
     # LOGGER.info('Requesting {} url'.format(url))
     print('Requesting {} url'.format(url))
-    random.shuffle(proxies)
-    proxy_pool = cycle(proxies)
 
     time.sleep(random.random() * 10)
-    session = requests.Session()
-    count = 0
-    num_proxies = len(proxies)
-
-    home_features = ['# of Beds', '# of Baths', '# of Dining Rooms', '# of Living Rooms',\
-                'Other Rooms', 'Dining Room Description', 'Kitchen Features', \
-                'Kitchen Appliances', 'School District', '# of Parking Spaces', \
-                'Parking Features', 'Year Built', '# of Fireplaces', 'Has HOA', \
-                'HOA Dues', 'Has Pool', 'Pool Features', '# of Stories', 'Area Amenities']
-
-    HEADER = {
-        'User-agent': 'Chrome'
-    }
-
-    while count <= num_proxies:
-        try:
-            proxy_element = next(proxy_pool)
-            proxy = construct_proxy(proxy_element[1], proxy_element[2])
-            session = requests.Session()
-            resp = session.get(url, headers=HEADER, timeout=30)
-            resp.raise_for_status()
-            print('Got {} status code.'.format(resp.status_code))
-
-            if resp.status_code == 200:
-                bf = BeautifulSoup(resp.text, 'lxml')
-                print('Scraping {} with proxy {}'.format(url, proxy))
-                # pull basic home information
-                address_div = bf.find('h1', {'class': 'address inline-block'})
-                address = address_div.find('span', {'class': 'street-address'}).text 
-                locality = address_div.find('span', {'class': 'locality'}).text 
-                region = address_div.find('span', {'class': 'region'}).text 
-                postal = address_div.find('span', {'class': 'postal-code'}).text 
-                redfin_price_description_div = bf.find('div', {'class': 'info-block price'})
-                redfin_estimate = redfin_price_description_div.find('div', {'class': 'statsValue'}).text
-                beds_div = bf.find('div', {'class': 'info-block', 'data-rf-test-id': 'abp-beds'})
-                num_beds = beds_div.find('div', {'class': 'statsValue'}).text
-                baths_div = bf.find('div', {'class': 'info-block', 'data-rf-test-id': 'abp-baths'})
-                num_baths = baths_div.find('div', {'class': 'statsValue'}).text
-                running_list = [address, locality, region, postal, redfin_estimate, num_beds, num_baths]
-                # find transportation scores for home
-                walking_div = bf.find('div', {'class': 'transport-icon-and-percentage walkscore'})
-                walkscore = walking_div.find('span', {'class': re.compile('value*')}).text
-                running_list.append(walkscore)
-                transit_div = bf.find('div', {'class': 'transport-icon-and-percentage transitscore'})
-                transitscore = transit_div.find('span', {'class': re.compile('value*')}).text
-                running_list.append(transitscore)
-                biking_div = bf.find('div', {'class': 'transport-icon-and-percentage bikescore'})
-                bikescore = biking_div.find('span', {'class': re.compile('value*')}).text
-                running_list.append(bikescore)
-                # find nearby school data for home
-                for element in bf.find_all('tr', {'class': 'schools-table-row'}):
-                    school_title = element.find('div', {'class': 'school-title'}).text
-                    school_distance = element.find('div', {'class': 'value'}).text
-                    school_rating = element.find('span', {'class': 'rating-num'}).text
-                    running_list.extend((school_title, school_distance, school_rating))
-                # pull data from the listing details container
-                for feature in home_features:
-                    appended = False
-                    for element in bf.find_all('span', {'class': 'entryItemContent'}):
-                        if ':' in element.text:
-                            if feature in element.text.split(':')[0]:
-                                running_list.append(element.text.split(':')[1].strip())
-                                appended = True
-                        else:
-                            if feature in element.text:
-                                running_list.append(element.text)
-                                appended = True
-                    if appended == False:
-                        running_list.append('NULL')
-                return running_list
-        except Exception as e:
-            print('failed for url {}, proxy {}'.format(url, proxy))
-            print('Exception: {}'.format(e))
-            count += 1
-            continue
-
-def get_home_urls(proxies):
+    try:
+        resp = fetch(url, proxies, conditional_header(HEADER, validators))
+    except FetchError as e:
+        print('failed for url {}'.format(url))
+        print('Exception: {}'.format(e))
+        return None
+
+    if resp.status_code == 304:
+        return url, validators, None
+
+    content_hash = hashlib.sha1(resp.content).hexdigest()
+    new_validators = (resp.headers.get('ETag'), resp.headers.get('Last-Modified'), content_hash)
+    if validators and validators[2] == content_hash:
+        # Same body as last time, skip parsing altogether.
+        return url, new_validators, None
+    try:
+        return url, new_validators, parse_home_info(resp.text)
+    except ParseError as e:
+        # Refetching would return the same page, so give up on it.
+        print('could not parse {}: {}'.format(url, e))
+        return None
+
+def get_home_urls(proxies, site='https://www.redfin.com'):
     """Utilize scrape_home_info function to retrieve home-specific data
     for all sold homes + active listings in the Austin area.
     Currently set up to pull urls from the active listings table.
+    Home pages are fetched from site, e.g. a local stand-in.
     """
     scrape_inputs = []
+    fetch_cache = load_fetch_cache()
     with sqlite3.connect(SQLITE_DB_PATH) as db:
         cursor = db.execute("""
             SELECT URL
             FROM LISTING_DETAILS
         """)
         for url_tail in cursor:
-            redfin_url = 'https://www.redfin.com' + ''.join(url_tail)
-            scrape_inputs.append((redfin_url, proxies))
+            redfin_url = site + ''.join(url_tail)
+            scrape_inputs.append((redfin_url, proxies, fetch_cache.get(redfin_url)))
     
     scraper_results = []
     with ProcessPoolExecutor(max_workers=min(50, len(scrape_inputs))) as executor:
         scraper_results = list(executor.map(scrape_home_info, scrape_inputs))
-    
-    with sqlite3.connect(SQLITE_DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("""
-            INSERT INTO LISTING_DETAILS (URL, ADDRESS, LOCALITY, REGION, POSTAL_CODE, PRICE, NUMBER_OF_BEDS, NUMBER_OF_BATHS,
-                                        WALK_SCORE, TRANSIT_SCORE, BIKE_SCORE, SCHOOL1_TITLE, SCHOOL1_DISTANCE, SCHOOL1_RATING,
-                                        SCHOOL2_TITLE, SCHOOL2_DISTANCE, SCHOOL2_RATING, SCHOOL3_TITLE, SCHOOL3_DISTANCE, 
-                                        SCHOOL3_RATING, NUMBER_OF_DINING_ROOMS, NUMBER_OF_LIVING_ROOMS, NUMBER_OF_OTHER_ROOMS,
-                                        DINING_ROOM_DESCRIPTION, KITCHEN_FEATURES, KITCHEN_APPLIANCES, SCHOOL_DISTRICT,
-                                        NUMBER_OF_PARKING_SPACES, PARKING_FEATURES, YEAR_BUILT, NUMBER_OF_FIREPLACES,
-                                        HOA, HOA_DUES, POOL, POOL_FEATURES, NUMBER_OF_STORIES, AREA_AMENITIES)
-            VALUES {};
-        """.format(','.join(scraper_results)))
-    
 
-# will need to change logic to run through random proxies until successful connection is made 
+    save_home_info(scraper_results)
+
+def save_isolated(cursor, save, url, *args):
+    """save(cursor, url, *args) inside a savepoint. A row that fails is
+    rolled back on its own and logged, and None is returned, so the rest
+    of the batch is still written.
+    """
+    cursor.execute('SAVEPOINT save_row')
+    try:
+        return save(cursor, url, *args)
+    except sqlite3.Error as e:
+        cursor.execute('ROLLBACK TO save_row')
+        print('could not save {}: {}'.format(url, e))
+        return None
+    finally:
+        cursor.execute('RELEASE save_row')
+
+def save_home_info(scraper_results, db=None):
+    """Write scrape_home_info results to LISTING_DETAILS and remember
+    their validators in FETCH_CACHE for the next conditional fetch.
+    Written on db inside the caller's transaction when given, otherwise
+    in a transaction of its own.
+    """
+    if db is None:
+        with sqlite3.connect(SQLITE_DB_PATH) as db:
+            return save_home_info(scraper_results, db)
+    # Failed fetches come back as None; unchanged pages carry no details.
+    scraper_results = [result for result in scraper_results if result]
+    changed = [(url, details) for url, _, details in scraper_results if details]
+    print('{} of {} home pages changed since the last run'.format(len(changed), len(scraper_results)))
+
+    cursor = db.cursor()
+    listing_ids, failed = [], set()
+    for url, details in changed:
+        listing_id = save_isolated(cursor, save_home_details, url, details, NUM_SCHOOLS)
+        if listing_id is None:
+            failed.add(url)
+        else:
+            listing_ids.append(listing_id)
+    update_rollups(cursor, listing_ids)
+    # No validators for pages that were not saved, so they are fetched in full next time.
+    # 304s and unchanged bodies usually bring the stored validators back; those rows are left alone.
+    cursor.executemany("""
+        INSERT INTO FETCH_CACHE (URL, ETAG, LAST_MODIFIED, CONTENT_HASH)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (URL) DO UPDATE SET
+            ETAG = excluded.ETAG, LAST_MODIFIED = excluded.LAST_MODIFIED, CONTENT_HASH = excluded.CONTENT_HASH
+        WHERE ETAG IS NOT excluded.ETAG OR LAST_MODIFIED IS NOT excluded.LAST_MODIFIED
+           OR CONTENT_HASH IS NOT excluded.CONTENT_HASH""",
+        [(url,) + tuple(validators) for url, validators, _ in scraper_results if url not in failed])
+
+
+@profiled('pagination')
 def scrape_page(url_and_proxies):
+    """Return (url, ld+json blocks) for a paginated search url.
+    Home cards come before the pagination links, so the download stops
+    once the pagination block has been parsed.
+    """
     url, proxies = url_and_proxies
-    random.shuffle(proxies)
-    proxy_pool = cycle(proxies)
     time.sleep(random.random() * 16)
-    details = []
-    num_proxies = len(proxies)
-    count = 0
-    while count <= num_proxies:
-        try:
-            proxy_element = next(proxy_pool)
-            proxy = construct_proxy(proxy_element[1], proxy_element[2])
-            session = requests.Session()
-            resp = session.get(url, headers=HEADER, proxies=proxy, timeout=30)
-            resp.raise_for_status()
-            print('Got {} status code.'.format(resp.status_code))
-
-            if resp.status_code == 200:
-                bf = BeautifulSoup(resp.text, 'lxml')
-                details = [json.loads(x.text) for x in bf.find_all('script', type='application/ld+json')]
-                return url, json.dumps(details)
+    try:
+        resp = fetch(url, proxies, stream=True)
+    except FetchError as e:
+        # LOGGER.exception('failed for url {}'.format(url))
+        print('failed for url {}: {}'.format(url, e))
+        return None
+
+    details, paging_div = [], None
+    try:
+        for element in iter_closed_elements(resp):
+            if element.tag == 'script' and element.get('type') == 'application/ld+json':
+                # An empty script has no text node; '' fails like any other bad block.
+                details.append(json.loads(element.text or ''))
+            elif element.tag == 'a' and has_class(element, 'goToPage'):
+                if paging_div is None:
+                    paging_div = next(element.iterancestors('div'), None)
+            elif element is paging_div:
+                break
+    except (requests.RequestException, etree.LxmlError) as e:
+        print('failed for url {}: {}'.format(url, e))
+        return None
+    except ValueError as e:
+        print('could not parse ld+json on {}: {}'.format(url, e))
+        return None
+    log_transfer('pagination', url, resp)
+    return url, json.dumps(details)
+
+def csv_download_url(url, endpoint=None):
+    """Export url for the same homes as a /city/<id>/.../filter/... search url."""
+    endpoint = endpoint or os.environ.get('REDFIN_CSV_ENDPOINT', CSV_ENDPOINT)
+    params = {'al': 1, 'num_homes': CSV_MAX_HOMES, 'page_number': 1, 'region_type': 6,
+              'status': 9, 'uipt': '1,2,3,4,5,6,7,8', 'v': 8}
+    m = re.search(r'/city/([0-9]+)/', url)
+    if m:
+        params['region_id'] = m.group(1)
+    m = re.search(r'include=([^,/]+)', url)
+    includes = m.group(1).split('+') if m else []
+    sale_flags = [SALE_FLAGS[include] for include in includes if include in SALE_FLAGS]
+    if sale_flags:
+        params['sf'] = ','.join(sale_flags)
+    sold = [SOLD_WITHIN_DAYS[include] for include in includes if include in SOLD_WITHIN_DAYS]
+    if sold:
+        params['sold_within_days'] = max(sold)
+    for key, value in parse_filter_params(url).items():
+        if value is not None:
+            params[CSV_FILTERS[key]] = value
+    return '{}?{}'.format(endpoint, urlencode(params))
+
+def csv_listing(row):
+    """(url path, LISTING_DETAILS values) for one export row, or None for
+    the disclaimer lines the export mixes in with the homes.
+    """
+    url = next((value for header, value in row.items() if header and header.startswith('URL')), None)
+    if not url or '/home/' not in url:
+        return None
+    values = {column: convert(column, row.get(header)) for header, column in CSV_COLUMNS.items()}
+    return listing_path(url), values
+
+@profiled('csv')
+def scrape_csv(url_and_proxies):
+    """Return (url, [(url path, values)]) for every home under a partition
+    url, from one export request instead of one page per 20 homes. Rows are
+    parsed as the response streams in.
+    """
+    url, proxies = url_and_proxies
+    time.sleep(random.random() * 16)
+    csv_url = csv_download_url(url)
+    try:
+        resp = fetch(csv_url, proxies, stream=True)
+    except FetchError as e:
+        print('failed for url {}: {}'.format(csv_url, e))
+        return None
+
+    # text/csv usually comes without a charset, which requests reads as Latin-1.
+    resp.encoding = 'utf-8-sig'
+    listings = []
+    try:
+        for row in csv.DictReader(resp.iter_lines(decode_unicode=True)):
+            listing = csv_listing(row)
+            if listing:
+                listings.append(listing)
+    except (requests.RequestException, csv.Error) as e:
+        print('failed for url {}: {}'.format(csv_url, e))
+        return None
+    finally:
+        resp.close()
+    if len(listings) >= CSV_MAX_HOMES:
+        print('export for {} stopped at {} homes and may be missing some, split or page through it'.format(
+            url, len(listings)))
+    log_transfer('csv', csv_url, resp)
+    return url, listings
+
+def save_csv_listings(scraper_results):
+    """Write scrape_csv results to LISTING_DETAILS."""
+    with sqlite3.connect(SQLITE_DB_PATH) as db:
+        cursor = db.cursor()
+        listing_ids = [save_isolated(cursor, upsert_listing, path, values)
+                       for result in scraper_results if result for path, values in result[1]]
+        listing_ids = [listing_id for listing_id in listing_ids if listing_id is not None]
+        update_rollups(cursor, listing_ids)
+    return listing_ids
+
+def csv_exportable(result):
+    """True when one export request returns every home of a get_page_info
+    result (or URLS row).
+    """
+    return result[1] != 0 and (result[1] or 0) <= CSV_MAX_HOMES
 
-        except Exception:
-            # LOGGER.exception('failed for url {}, proxy {}'.format(url, proxy))
-            print('failed for url {}, proxy {}'.format(url, proxy))
-            count += 1
-            continue
+def get_csv_partitions(prefix):
+    """The leaf partitions of url_partition, one url each, that a single
+    export can return in full. Leaves that are too big for it are listed,
+    not exported.
+    """
+    with sqlite3.connect(SQLITE_DB_PATH) as db:
+        cursor = db.execute("""
+            SELECT URL, NUM_PROPERTIES, NUM_PAGES, PER_PAGE_PROPERTIES
+            FROM URLS
+        """)
+        rows = {row[0]: row for row in cursor if not prefix or prefix in row[0]}
+    # The search url itself has no filters and is always split, whatever its size.
+    leaves = [row for url, row in rows.items()
+              if any(value is not None for value in parse_filter_params(url).values()) and not needs_split(row)]
+    oversized = [row[0] for row in leaves if row[1] and not csv_exportable(row)]
+    if oversized:
+        print('{} partitions hold more than the {} homes an export returns, page through them instead: {}'.format(
+            len(oversized), CSV_MAX_HOMES, oversized))
+    return [row[0] for row in leaves if csv_exportable(row)]
+
+def crawl_redfin_csv(proxies, prefix=''):
+    """Enumerate listings through the CSV export, one request per
+    url_partition partition, in place of crawl_redfin_with_proxies and
+    parse_addresses.
+    """
+    partitions = get_csv_partitions(prefix)
+    if not partitions:
+        return
+    with ProcessPoolExecutor(max_workers=min(50, len(partitions))) as executor:
+        scraper_results = list(executor.map(scrape_csv, [(url, proxies) for url in partitions]))
+    listing_ids = save_csv_listings(scraper_results)
+    print('Saved {} listings from {} of {} partitions'.format(
+        len(listing_ids), sum(1 for result in scraper_results if result), len(partitions)))
 
-# will need to change logic to run through random proxies until successful connection is made 
 def crawl_redfin_with_proxies(proxies, prefix=''):
     small_urls = get_paginated_urls(prefix)
     # rand_move = random.randint(0, len(proxies) - 1)
@@ -482,6 +792,8 @@ def crawl_redfin_with_proxies(proxies, prefix=''):
     with sqlite3.connect(SQLITE_DB_PATH) as db:
         cursor = db.cursor()
         for result in scraper_results:
+            if not result:
+                continue
             url, info = result
             try:
                 cursor.execute("""
@@ -493,6 +805,16 @@ def crawl_redfin_with_proxies(proxies, prefix=''):
                 print('failed record: {}'.format(result))
                 print(e)
 
+def listing_geo(info):
+    """Return (latitude, longitude, square feet) from an ld+json listing,
+    with None for anything the block does not carry.
+    """
+    geo = info.get('geo') or {}
+    floor_size = info.get('floorSize') or {}
+    if not isinstance(floor_size, dict):
+        floor_size = {'value': floor_size}
+    return geo.get('latitude'), geo.get('longitude'), floor_size.get('value')
+
 def parse_addresses():
     listing_details = {}
     with sqlite3.connect(SQLITE_DB_PATH) as db:
@@ -510,6 +832,7 @@ def parse_addresses():
                 # print('listing {}'.format(listing))
                 num_rooms, name, country, region, locality, street, postal, house_type, price = \
                     None, None, None, None, None, None, None, None, None
+                latitude, longitude, sqft = None, None, None
                 listing_url = None
                 if (not isinstance(listing, list)) and (not isinstance(listing, dict)):
                     continue
@@ -527,8 +850,10 @@ def parse_addresses():
                         street = address_details.get('streetAddress')
                         postal = address_details.get('postalCode')
                         house_type = info.get('@type')
+                        latitude, longitude, sqft = listing_geo(info)
                         listing_details[listing_url] = (listing_url, num_rooms, name, country,
-                                                        region, locality, street, postal, house_type, price)
+                                                        region, locality, street, postal, house_type, price,
+                                                        latitude, longitude, sqft)
                     continue
 
                 for info in listing:
@@ -543,33 +868,25 @@ def parse_addresses():
                         street = address_details.get('streetAddress')
                         postal = address_details.get('postalCode')
                         house_type = info.get('@type')
+                        latitude, longitude, sqft = listing_geo(info)
                     if 'offers' in info:
                         price = info['offers'].get('price')
                 if listing_url:
                     listing_details[listing_url] = (listing_url, num_rooms, name, country,
-                                                    region, locality, street, postal, house_type, price)
+                                                    region, locality, street, postal, house_type, price,
+                                                    latitude, longitude, sqft)
 
     # print(listing_details)
     with sqlite3.connect(SQLITE_DB_PATH) as db:
         cursor = db.cursor()
-        try:
-            cursor.executemany("""
-                INSERT INTO LISTING_DETAILS (
-                             URL,
-                             NUMBER_OF_ROOMS,
-                             NAME     ,
-                             COUNTRY  ,
-                             REGION    ,
-                             LOCALITY  ,
-                             STREET    ,
-                             POSTOAL   ,
-                             TYPE      ,
-                             PRICE)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """, listing_details.values())
-        except Exception as e:
-            # LOGGER.info(e)
-            print(e)
+        listing_ids = []
+        for listing_url, *summary in listing_details.values():
+            try:
+                listing_ids.append(save_listing_summary(cursor, listing_url, summary))
+            except Exception as e:
+                # LOGGER.info(e)
+                print(e)
+        update_rollups(cursor, listing_ids)
 
 def get_home_info(proxies):
 
@@ -587,25 +904,40 @@ def get_home_info(proxies):
 
 if __name__ == '__main__':
     # base_url = 'https://www.redfin.com/city/1362/CA/Belmont/filter/include=sold-3yr'
-    base_url = 'https://www.redfin.com/city/30818/TX/Austin/filter/include=forsale+mlsfsbo+construction+fsbo+sold-3yr'
-
-    SQLITE_DB_PATH = 'redfin-scraper-data.db'
 
     LOGGER = None
 
-    HEADER = {
-        'User-agent': 'Chrome'
-    }
+    parser = argparse.ArgumentParser(description='Scrape sold and active listings from Redfin.')
+    parser.add_argument('--profile', type=float, default=0, metavar='RATE',
+                        help='profile this fraction of the pages fetched by each stage, e.g. 0.01')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--csv', action='store_true',
+                        help='enumerate listings through the CSV export instead of the paginated search pages')
+    parser.add_argument('--csv-endpoint', help='CSV export url, e.g. a local stand-in for testing')
+    parser.add_argument('--direct', action='store_true', help='fetch without proxies, e.g. from a local stand-in')
+    parser.add_argument('--site', help='site to fetch the home pages from, '
+                                       'by default the --csv-endpoint host or https://www.redfin.com')
+    args = parser.parse_args()
+    site = args.site or ('{0.scheme}://{0.netloc}'.format(urlparse(args.csv_endpoint)) if args.csv_endpoint
+                         else 'https://www.redfin.com')
+    base_url = site + '/city/30818/TX/Austin/filter/include=forsale+mlsfsbo+construction+fsbo+sold-3yr'
+    if args.profile:
+        enable_profiling(args.profile, args.profile_dir)
+    if args.csv_endpoint:
+        os.environ['REDFIN_CSV_ENDPOINT'] = args.csv_endpoint
 
     create_tables_if_not_exist()
     
     proxy_csv_path = 'proxy.csv'
-    proxies = pd.read_csv(proxy_csv_path, encoding='utf-8').values
-    proxies = proxies.tolist()
+    proxies = [] if args.direct else pd.read_csv(proxy_csv_path, encoding='utf-8').values.tolist()
 
     # url_partition(base_url, proxies)
+    if args.csv:
+        crawl_redfin_csv(proxies)
     # crawl_redfin_with_proxies(proxies)
     # parse_addresses()
-    get_home_urls(proxies)
+    get_home_urls(proxies, site)
+    if args.profile:
+        aggregate_profiles(args.profile_dir)
     # urls_df = pd.DataFrame(urls, columns = ['URL', 'NUM_PROPERTIES', 'NUM_PAGES', 'PER_PAGE_PROPERTIES'])
     # print(urls_df)
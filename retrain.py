@@ -0,0 +1,222 @@
+import os
+import json
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from features import FEATURE_DIR, write_feature_matrix, load_feature_matrix, iter_batches
+from price_model import train_sgd, train_hist_gbm, evaluate, save_model, load_model
+from tuning import best_params
+
+MODEL_DIR = 'models'
+
+# Population stability index above which a feature is considered drifted.
+PSI_THRESHOLD = 0.2
+# Retrain from scratch when the current model's error on the new listings
+# exceeds its holdout error by this factor.
+ERROR_RATIO_THRESHOLD = 1.25
+
+def create_versions_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS MODEL_VERSIONS
+            (
+            VERSION            INTEGER PRIMARY KEY,
+            PARENT             INT,
+            KIND               TEXT    NOT NULL,
+            MODEL_TYPE         TEXT    NOT NULL,
+            MODEL_PATH         TEXT    NOT NULL,
+            MAX_LISTING_ID     INT     NOT NULL,
+            MAX_ROW_VERSION    INT,
+            TRAIN_ROWS         INT,
+            NEW_ROWS           INT,
+            BASELINE_LOG_MAE   REAL,
+            NEW_ROWS_LOG_MAE   REAL,
+            PSI                REAL,
+            REFERENCE          TEXT,
+            CREATED_AT         TEXT);''')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(MODEL_VERSIONS)')}
+    if 'MAX_ROW_VERSION' not in columns:
+        conn.execute('ALTER TABLE MODEL_VERSIONS ADD COLUMN MAX_ROW_VERSION INT')
+
+def latest_version(conn):
+    create_versions_table(conn)
+    row = conn.execute('SELECT * FROM MODEL_VERSIONS ORDER BY VERSION DESC LIMIT 1').fetchone()
+    if row is None:
+        return None
+    columns = [column[0] for column in conn.execute('SELECT * FROM MODEL_VERSIONS LIMIT 0').description]
+    return dict(zip(columns, row))
+
+def bin_counts(X, edges):
+    """Rows per bin for every feature, with a last bin for missing values."""
+    counts = []
+    for column, column_edges in zip(np.asarray(X).T, edges):
+        missing = np.isnan(column)
+        present = np.bincount(np.searchsorted(column_edges, column[~missing], side='right'),
+                              minlength=len(column_edges) + 1)
+        counts.append(np.append(present, missing.sum()))
+    return counts
+
+def feature_reference(X, bins=10, max_rows=100000):
+    """Decile edges of every feature and the share of rows in each bin,
+    from an evenly strided sample of X.
+    """
+    sample = np.asarray(X[::max(1, len(X) // max_rows)])
+    edges = []
+    for column in sample.T:
+        present = column[~np.isnan(column)]
+        edges.append(np.unique(np.quantile(present, np.linspace(0, 1, bins + 1)[1:-1])).tolist()
+                     if len(present) else [])
+    return {'edges': edges, 'shares': [(counts / len(sample)).tolist() for counts in bin_counts(sample, edges)]}
+
+def population_stability(reference, X, batch_size=100000):
+    """Largest PSI over the features between the reference distribution
+    and the rows of X. Only the values present are compared: new rows
+    often lack features their detail pages have not been fetched for yet.
+    """
+    totals = [np.zeros(len(edges) + 2) for edges in reference['edges']]
+    for start, stop in iter_batches(len(X), batch_size):
+        for total, counts in zip(totals, bin_counts(X[start:stop], reference['edges'])):
+            total += counts
+    worst = 0.0
+    for expected, total in zip(reference['shares'], totals):
+        expected, present = np.array(expected[:-1]), total[:-1]
+        if not expected.sum() or not present.sum():
+            continue
+        expected = np.maximum(expected / expected.sum(), 1e-4)
+        actual = np.maximum(present / present.sum(), 1e-4)
+        worst = max(worst, float(np.sum((actual - expected) * np.log(actual / expected))))
+    return worst
+
+def save_version(conn, model, version):
+    create_versions_table(conn)
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    number = (conn.execute('SELECT MAX(VERSION) FROM MODEL_VERSIONS').fetchone()[0] or 0) + 1
+    version = dict(version, VERSION=number, MODEL_PATH=os.path.join(MODEL_DIR, 'price_model-v{}.pkl'.format(number)),
+                   CREATED_AT=datetime.now().isoformat(timespec='seconds'))
+    save_model(model, version['MODEL_PATH'])
+    columns = list(version)
+    conn.execute('INSERT INTO MODEL_VERSIONS ({}) VALUES ({})'.format(
+        ', '.join(columns), ', '.join(['?'] * len(columns))), [version[c] for c in columns])
+    conn.commit()
+    print('Saved {} model version {} ({} rows, holdout log MAE {})'.format(
+        version['KIND'], number, version['TRAIN_ROWS'], version['BASELINE_LOG_MAE']))
+    return version
+
+def full_retrain(conn, feature_dir=FEATURE_DIR, model_type='hgb', params=None, parent=None, validation_fraction=0.1):
+    """Rewrite the whole feature matrix and train a new model from scratch.
+    The last validation_fraction of the rows is the holdout that the error
+    of later increments is compared against. The model never sees it: the
+    boosted model's early stopping uses the end of the training rows.
+    """
+    write_feature_matrix(conn, feature_dir)
+    X, y, _, meta = load_feature_matrix(feature_dir)
+    split = int(len(X) * (1 - validation_fraction))
+    if model_type == 'sgd':
+        model = train_sgd(X[:split], y[:split], meta)
+    else:
+        model = train_hist_gbm(X[:split], y[:split], meta, validation_fraction, **(params or {}))
+    return save_version(conn, model, {
+        'PARENT': parent, 'KIND': 'full', 'MODEL_TYPE': model_type, 'MAX_LISTING_ID': meta['max_listing_id'],
+        'MAX_ROW_VERSION': meta['max_version'],
+        'TRAIN_ROWS': len(X), 'NEW_ROWS': len(X),
+        'BASELINE_LOG_MAE': evaluate(model, X[split:], y[split:])['LOG_MAE'],
+        'REFERENCE': json.dumps(feature_reference(X)),
+    })
+
+def warm_start(model, model_type, X, y, extra_rounds=20, learning_rate=0.05, epochs=3):
+    """Fit the model further on the new rows only: a few more boosting
+    rounds on its residuals for the boosted model, more partial_fit passes
+    for the linear one.
+    """
+    if model_type == 'sgd':
+        for epoch in range(epochs):
+            for start, stop in iter_batches(len(X), 10000, seed=epoch):
+                model.estimator.partial_fit(model.transform(X[start:stop]), y[start:stop])
+        return model
+    # Extra stages are separate estimators: HistGradientBoostingRegressor's own
+    # warm_start re-bins the new X, which the existing trees' bins do not match.
+    residuals = y - model.predict(X)
+    # A feature none of the new rows have (e.g. walk scores of homes whose
+    # detail pages are not fetched yet) is constant to the correction, but
+    # the binning needs at least one value.
+    empty = np.flatnonzero(np.isnan(X).all(axis=0)) if len(X) else []
+    if len(empty):
+        X = np.array(X)
+        X[:, empty] = 0
+    correction = HistGradientBoostingRegressor(max_iter=extra_rounds, learning_rate=learning_rate,
+                                               min_samples_leaf=max(5, min(20, len(X) // 50)),
+                                               early_stopping=False)
+    correction.fit(X, residuals)
+    model.corrections.append(correction)
+    return model
+
+def refresh_model(conn, feature_dir=FEATURE_DIR, model_type='hgb', search_id=None, psi_threshold=PSI_THRESHOLD,
+                  error_ratio_threshold=ERROR_RATIO_THRESHOLD, min_drift_rows=500, max_corrections=30,
+                  extra_rounds=20):
+    """Bring the price model up to date with listings added or changed since
+    the last version (ROW_VERSION above its watermark). The latest model is
+    updated in place of a full retrain unless the new rows have drifted: a
+    feature PSI above psi_threshold, or an error on the new rows above
+    error_ratio_threshold times the last full model's holdout error.
+    """
+    latest = latest_version(conn)
+    params = best_params(conn, search_id) if search_id else None
+    if latest is None:
+        print('No model yet, training from scratch')
+        return full_retrain(conn, feature_dir, model_type, params)
+    if latest['MAX_ROW_VERSION'] is None:
+        print('Model version {} has no ROW_VERSION watermark, training from scratch'.format(latest['VERSION']))
+        return full_retrain(conn, feature_dir, model_type, params, parent=latest['VERSION'])
+
+    delta_dir = os.path.join(feature_dir, 'delta')
+    write_feature_matrix(conn, delta_dir, after_version=latest['MAX_ROW_VERSION'])
+    X, y, _, meta = load_feature_matrix(delta_dir)
+    if not len(X):
+        print('No new or changed listings since model version {}'.format(latest['VERSION']))
+        return latest
+
+    model = load_model(latest['MODEL_PATH'])
+    reference = json.loads(latest['REFERENCE'])
+    new_rows_error = evaluate(model, X, y)['LOG_MAE']
+    psi = population_stability(reference, X) if len(X) >= min_drift_rows else None
+    error_ratio = new_rows_error / latest['BASELINE_LOG_MAE'] if latest['BASELINE_LOG_MAE'] else None
+    print('{} new or changed listings: PSI {}, log MAE {:.4f} vs holdout {}'.format(
+        len(X), psi, new_rows_error, latest['BASELINE_LOG_MAE']))
+
+    drifted = len(X) >= min_drift_rows and (psi > psi_threshold or (error_ratio or 0) > error_ratio_threshold)
+    if drifted or len(model.corrections) >= max_corrections or model_type != latest['MODEL_TYPE']:
+        print('Retraining from scratch')
+        return full_retrain(conn, feature_dir, model_type, params, parent=latest['VERSION'])
+
+    model = warm_start(model, latest['MODEL_TYPE'], X, y, extra_rounds)
+    return save_version(conn, model, {
+        'PARENT': latest['VERSION'], 'KIND': 'incremental', 'MODEL_TYPE': latest['MODEL_TYPE'],
+        'MAX_LISTING_ID': meta['max_listing_id'], 'MAX_ROW_VERSION': meta['max_version'],
+        'TRAIN_ROWS': (latest['TRAIN_ROWS'] or 0) + len(X),
+        'NEW_ROWS': len(X), 'BASELINE_LOG_MAE': latest['BASELINE_LOG_MAE'], 'NEW_ROWS_LOG_MAE': new_rows_error,
+        'PSI': psi, 'REFERENCE': latest['REFERENCE'],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the price model with the listings added since the last version.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--feature-dir', default=FEATURE_DIR)
+    parser.add_argument('--model', choices=['hgb', 'sgd'], default='hgb')
+    parser.add_argument('--search-id', help='use the best configuration of this tuning search on full retrains')
+    parser.add_argument('--psi-threshold', type=float, default=PSI_THRESHOLD)
+    parser.add_argument('--error-ratio-threshold', type=float, default=ERROR_RATIO_THRESHOLD)
+    parser.add_argument('--extra-rounds', type=int, default=20)
+    parser.add_argument('--full', action='store_true', help='retrain from scratch regardless of drift')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if args.full:
+        latest = latest_version(conn)
+        full_retrain(conn, args.feature_dir, args.model, best_params(conn, args.search_id) if args.search_id else None,
+                     parent=latest and latest['VERSION'])
+    else:
+        refresh_model(conn, args.feature_dir, args.model, args.search_id, args.psi_threshold,
+                      args.error_ratio_threshold, extra_rounds=args.extra_rounds)
+    conn.close()
@@ -0,0 +1,225 @@
+import json
+import math
+import sqlite3
+import argparse
+from collections import defaultdict
+
+from addresses import canonical_zip
+
+# Relative accuracy of the quantile sketches: a reported median is within
+# 1% of a value that really sits at that rank.
+SKETCH_ALPHA = 0.01
+
+METRICS = ['PRICE', 'PPSF', 'DOM']
+
+def has_rollups(conn):
+    return conn.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ROLLUP_MEMBERS'""").fetchone() is not None
+
+def create_rollup_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS MARKET_ROLLUPS
+            (
+            DIMENSION                 TEXT    NOT NULL,
+            KEY                       TEXT    NOT NULL,
+            LISTING_COUNT             INT     DEFAULT 0,
+            PRICE_COUNT               INT     DEFAULT 0,
+            PRICE_SUM                 REAL    DEFAULT 0,
+            PRICE_SKETCH              TEXT,
+            PPSF_COUNT                INT     DEFAULT 0,
+            PPSF_SUM                  REAL    DEFAULT 0,
+            PPSF_SKETCH               TEXT,
+            DOM_COUNT                 INT     DEFAULT 0,
+            DOM_SUM                   REAL    DEFAULT 0,
+            DOM_SKETCH                TEXT,
+            P25_PRICE                 REAL,
+            MEDIAN_PRICE              REAL,
+            P75_PRICE                 REAL,
+            MEDIAN_PPSF               REAL,
+            MEDIAN_DOM                REAL,
+            PRIMARY KEY (DIMENSION, KEY)
+            ) WITHOUT ROWID;''')
+    # What each listing currently contributes, so an updated listing can be
+    # taken back out of the rollups before its new values go in.
+    conn.execute('''CREATE TABLE IF NOT EXISTS ROLLUP_MEMBERS
+            (
+            LISTING_ID                INTEGER PRIMARY KEY,
+            POSTAL_CODE               TEXT,
+            SCHOOL_DISTRICT           TEXT,
+            MONTH                     TEXT,
+            PRICE                     REAL,
+            PPSF                      REAL,
+            DOM                       REAL
+            );''')
+
+
+class QuantileSketch:
+    """Mergeable log-bucketed histogram (DDSketch). Each positive value goes
+    to bucket ceil(log_gamma(value)), so quantiles have relative error
+    SKETCH_ALPHA. Counts can be decremented, which lets a listing be removed
+    again when it is updated.
+    """
+
+    def __init__(self, buckets=None, alpha=SKETCH_ALPHA):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = defaultdict(int, buckets or {})
+
+    @classmethod
+    def from_json(cls, text):
+        if not text:
+            return cls()
+        return cls({int(index): count for index, count in json.loads(text).items()})
+
+    def to_json(self):
+        return json.dumps({index: count for index, count in self.buckets.items() if count})
+
+    def bucket(self, value):
+        if value <= 0:
+            return None
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value, count=1):
+        index = self.bucket(value)
+        if index is None:
+            index = -(1 << 30)
+        self.buckets[index] += count
+
+    def quantile(self, q):
+        total = sum(self.buckets.values())
+        if total <= 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                if index == -(1 << 30):
+                    return 0.0
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return None
+
+
+def listing_metrics(price, sqft, dom):
+    return {'PRICE': price, 'PPSF': price / sqft if price is not None and sqft else None, 'DOM': dom}
+
+def rollup_keys(postal, district, month):
+    """(dimension, key) pairs a listing is counted under."""
+    keys = [('ZIP', postal), ('DISTRICT', district), ('MONTH', month)]
+    if postal and month:
+        keys.append(('ZIP_MONTH', '{}|{}'.format(postal, month)))
+    return [key for key in keys if key[1]]
+
+def update_rollups(conn, listing_ids):
+    """Fold the current values of listing_ids into MARKET_ROLLUPS, replacing
+    whatever they contributed before. Only the rollup rows those listings
+    touch are read and rewritten.
+    """
+    listing_ids = list(set(listing_ids))
+    if not listing_ids:
+        return
+    deltas = defaultdict(lambda: {'LISTING_COUNT': 0, 'SUMS': defaultdict(float),
+                                  'COUNTS': defaultdict(int), 'VALUES': defaultdict(list)})
+
+    def apply(keys, metrics, sign):
+        for key in keys:
+            delta = deltas[key]
+            delta['LISTING_COUNT'] += sign
+            for metric, value in metrics.items():
+                if value is not None:
+                    delta['SUMS'][metric] += sign * value
+                    delta['COUNTS'][metric] += sign
+                    delta['VALUES'][metric].append((value, sign))
+
+    for i in range(0, len(listing_ids), 500):
+        batch = listing_ids[i:i + 500]
+        placeholders = ', '.join(['?'] * len(batch))
+        for postal, district, month, price, ppsf, dom in conn.execute("""
+                SELECT POSTAL_CODE, SCHOOL_DISTRICT, MONTH, PRICE, PPSF, DOM
+                FROM ROLLUP_MEMBERS WHERE LISTING_ID IN ({})""".format(placeholders), batch):
+            apply(rollup_keys(postal, district, month), {'PRICE': price, 'PPSF': ppsf, 'DOM': dom}, -1)
+        members = []
+        for listing_id, postal, district, month, price, sqft, dom in conn.execute("""
+                SELECT LISTING_ID, POSTAL_CODE, SCHOOL_DISTRICT, SUBSTR(SOLD_DATE, 1, 7), PRICE, SQFT, DAYS_ON_MARKET
+                FROM LISTING_DETAILS WHERE LISTING_ID IN ({}) AND PRICE IS NOT NULL""".format(placeholders), batch):
+            # '78701-0001' and '78701' are the same ZIP; a merge can change which one a row carries.
+            postal = canonical_zip(postal) or None
+            metrics = listing_metrics(price, sqft, dom)
+            apply(rollup_keys(postal, district, month), metrics, 1)
+            members.append((listing_id, postal, district, month, price, metrics['PPSF'], dom))
+        conn.execute('DELETE FROM ROLLUP_MEMBERS WHERE LISTING_ID IN ({})'.format(placeholders), batch)
+        conn.executemany('INSERT INTO ROLLUP_MEMBERS VALUES (?, ?, ?, ?, ?, ?, ?)', members)
+
+    for (dimension, key), delta in deltas.items():
+        row = conn.execute("""
+            SELECT LISTING_COUNT, PRICE_COUNT, PRICE_SUM, PRICE_SKETCH, PPSF_COUNT, PPSF_SUM, PPSF_SKETCH,
+                   DOM_COUNT, DOM_SUM, DOM_SKETCH
+            FROM MARKET_ROLLUPS WHERE DIMENSION = ? AND KEY = ?""", (dimension, key)).fetchone()
+        row = row or (0, 0, 0, None, 0, 0, None, 0, 0, None)
+        listing_count = row[0] + delta['LISTING_COUNT']
+        if listing_count <= 0:
+            conn.execute('DELETE FROM MARKET_ROLLUPS WHERE DIMENSION = ? AND KEY = ?', (dimension, key))
+            continue
+        values = {'LISTING_COUNT': listing_count}
+        sketches = {}
+        for i, metric in enumerate(METRICS):
+            sketch = QuantileSketch.from_json(row[3 + 3 * i])
+            for value, sign in delta['VALUES'][metric]:
+                sketch.add(value, sign)
+            sketches[metric] = sketch
+            values[metric + '_COUNT'] = row[1 + 3 * i] + delta['COUNTS'][metric]
+            values[metric + '_SUM'] = row[2 + 3 * i] + delta['SUMS'][metric]
+            values[metric + '_SKETCH'] = sketch.to_json()
+        values['P25_PRICE'] = sketches['PRICE'].quantile(0.25)
+        values['MEDIAN_PRICE'] = sketches['PRICE'].quantile(0.5)
+        values['P75_PRICE'] = sketches['PRICE'].quantile(0.75)
+        values['MEDIAN_PPSF'] = sketches['PPSF'].quantile(0.5)
+        values['MEDIAN_DOM'] = sketches['DOM'].quantile(0.5)
+        columns = list(values)
+        conn.execute("""
+            INSERT OR REPLACE INTO MARKET_ROLLUPS (DIMENSION, KEY, {})
+            VALUES (?, ?, {})""".format(', '.join(columns), ', '.join(['?'] * len(columns))),
+            [dimension, key] + [values[c] for c in columns])
+
+def rebuild_rollups(conn):
+    """Recompute every rollup from LISTING_DETAILS, e.g. on first use."""
+    conn.execute('DELETE FROM MARKET_ROLLUPS')
+    conn.execute('DELETE FROM ROLLUP_MEMBERS')
+    listing_ids = [row[0] for row in conn.execute('SELECT LISTING_ID FROM LISTING_DETAILS WHERE PRICE IS NOT NULL')]
+    update_rollups(conn, listing_ids)
+    print('Rolled up {} listings'.format(len(listing_ids)))
+
+def market_summary(conn, dimension, key=None):
+    """Dashboard rows for a dimension ('ZIP', 'DISTRICT', 'MONTH' or
+    'ZIP_MONTH'), optionally for a single key. A primary key lookup.
+    """
+    query = """
+        SELECT KEY, LISTING_COUNT, P25_PRICE, MEDIAN_PRICE, P75_PRICE, PRICE_SUM / NULLIF(PRICE_COUNT, 0),
+               MEDIAN_PPSF, MEDIAN_DOM, DOM_SUM / NULLIF(DOM_COUNT, 0)
+        FROM MARKET_ROLLUPS WHERE DIMENSION = ?"""
+    params = [dimension]
+    if key is not None and dimension == 'ZIP':
+        key = canonical_zip(key) or key
+    if key is not None:
+        query += ' AND KEY = ?'
+        params.append(key)
+    columns = ['KEY', 'LISTING_COUNT', 'P25_PRICE', 'MEDIAN_PRICE', 'P75_PRICE', 'MEAN_PRICE',
+               'MEDIAN_PPSF', 'MEDIAN_DOM', 'MEAN_DOM']
+    return [dict(zip(columns, row)) for row in conn.execute(query + ' ORDER BY KEY', params)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Market rollups by ZIP, school district and month.')
+    parser.add_argument('--db', default='redfin-scraper-data.db')
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--dimension', default='ZIP', choices=['ZIP', 'DISTRICT', 'MONTH', 'ZIP_MONTH'])
+    parser.add_argument('--key')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    create_rollup_tables(conn)
+    if args.rebuild:
+        rebuild_rollups(conn)
+        conn.commit()
+    for summary in market_summary(conn, args.dimension, args.key):
+        print(summary)
+    conn.close()
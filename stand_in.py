@@ -0,0 +1,273 @@
+import io
+import os
+import re
+import csv
+import json
+import time
+import random
+import signal
+import hashlib
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import redfin_urls
+import distributed_crawl
+from filters import parse_filter_params
+from listing_schema import upsert_listing
+
+# A local stand-in for the redfin.com pages the crawler reads: search result
+# pages (partition and pagination stages), the CSV export and home detail
+# pages, generated from a fixed set of fake homes. Point the crawl at it and fetch without
+# proxies to exercise the pipeline end to end without touching the site.
+
+CITY_PATH = '/city/30818/TX/Austin/filter/include=sold-3yr'
+CSV_PATH = urlparse(redfin_urls.CSV_ENDPOINT).path
+PER_PAGE = 20
+MAX_PAGES = 18
+STREETS = ['Elm', 'Oak', 'Cedar', 'Pecan', 'Mesquite', 'Live Oak', 'Barton Hills', 'Congress']
+
+def stand_in_homes(num_homes=200, seed=0):
+    """num_homes fake Austin homes, the same ones for the same seed."""
+    rng = random.Random(seed)
+    homes = []
+    for i in range(num_homes):
+        street = '{} {} St'.format(rng.randint(100, 9999), rng.choice(STREETS))
+        postal = '787{:02d}'.format(rng.randint(1, 60))
+        homes.append({
+            'id': 100000 + i,
+            'path': '/TX/Austin/{}-{}/home/{}'.format(street.replace(' ', '-'), postal, 100000 + i),
+            'street': street,
+            'postal': postal,
+            'price': rng.randrange(50000, 1500000, 1000),
+            'beds': rng.randint(1, 6),
+            'baths': rng.choice([1, 1.5, 2, 2.5, 3, 4]),
+            'sqft': rng.randrange(600, 5000, 10),
+            'year': rng.randint(1920, 2017),
+            'latitude': round(30.2 + rng.uniform(-0.2, 0.2), 6),
+            'longitude': round(-97.75 + rng.uniform(-0.2, 0.2), 6),
+            'sold': '{}-{:02d}-2023'.format(rng.choice(['January', 'March', 'June', 'October']), rng.randint(1, 28)),
+        })
+    return homes
+
+def matching_homes(homes, params):
+    """The homes within parse_filter_params style ranges, cheapest first."""
+    ranges = [('price', params['min_price'], params['max_price']),
+              ('sqft', params['min_sqft'], params['max_sqft']),
+              ('year', params['min_year'], params['max_year'])]
+    return sorted((home for home in homes
+                   if all((low is None or home[key] >= low) and (high is None or home[key] < high)
+                          for key, low, high in ranges)),
+                  key=lambda home: home['price'])
+
+def search_page(homes, page=1):
+    """A search result page laid out the way get_page_info and scrape_page
+    read it: the summary, one ld+json block per home, then the page links.
+    """
+    shown = homes[(page - 1) * PER_PAGE:page * PER_PAGE]
+    parts = ['<html><body>']
+    if len(homes) > PER_PAGE:
+        parts.append('<div class="homes summary">Showing {} of {} Homes</div>'.format(len(shown), len(homes)))
+    elif homes:
+        parts.append('<div class="homes summary">Showing {} Homes</div>'.format(len(homes)))
+    for home in shown:
+        listing = [{'@type': 'SingleFamilyResidence', 'url': home['path'], 'name': home['street'],
+                    'address': {'streetAddress': home['street'], 'addressLocality': 'Austin',
+                                'addressRegion': 'TX', 'postalCode': home['postal'], 'addressCountry': 'US'},
+                    'geo': {'latitude': home['latitude'], 'longitude': home['longitude']},
+                    'floorSize': {'value': home['sqft']}, 'numberOfRooms': home['beds']},
+                   {'offers': {'price': home['price']}}]
+        parts.append('<div class="HomeCard"><script type="application/ld+json">{}</script></div>'.format(
+            json.dumps(listing)))
+    num_pages = min(MAX_PAGES, -(-len(homes) // PER_PAGE))
+    if num_pages > 1:
+        parts.append('<div class="PagingControls">{}</div>'.format(''.join(
+            '<a class="goToPage">{}</a>'.format(p) for p in range(1, num_pages + 1))))
+    parts.append('<div class="footer">{}</div></body></html>'.format('<p>filler</p>' * 200))
+    return ''.join(parts)
+
+def csv_params(query):
+    """parse_filter_params style ranges from a CSV export query string."""
+    query = parse_qs(query)
+    return {key: int(query[param][0]) if param in query else None
+            for key, param in redfin_urls.CSV_FILTERS.items()}
+
+def csv_export(homes, site, num_homes=redfin_urls.CSV_MAX_HOMES):
+    """The export laid out the way scrape_csv reads it: a BOM, the header,
+    the MLS disclaimer line, then one row per home.
+    """
+    out = io.StringIO()
+    writer = csv.writer(out)
+    headers = ['SALE TYPE'] + list(redfin_urls.CSV_COLUMNS) + [
+        'URL (SEE https://www.redfin.com/buy-a-home/comparative-market-analysis FOR INFO ON PRICING)']
+    writer.writerow(headers)
+    writer.writerow(['In accordance with local MLS rules, some MLS listings are not included in the download'])
+    for home in homes[:num_homes]:
+        values = {'ADDRESS': home['street'], 'CITY': 'Austin', 'STATE OR PROVINCE': 'TX',
+                  'ZIP OR POSTAL CODE': home['postal'], 'PROPERTY TYPE': 'Single Family Residential',
+                  'PRICE': home['price'], 'BEDS': home['beds'], 'BATHS': home['baths'], 'SQUARE FEET': home['sqft'],
+                  'YEAR BUILT': home['year'], 'SOLD DATE': home['sold'],
+                  'LATITUDE': home['latitude'], 'LONGITUDE': home['longitude']}
+        writer.writerow(['PAST SALE'] + [values.get(header, '') for header in redfin_urls.CSV_COLUMNS]
+                        + [site + home['path']])
+    return '\ufeff' + out.getvalue()
+
+def home_page(home):
+    """A detail page with the fields parse_home_info looks for."""
+    sold = datetime.strptime(home['sold'], '%B-%d-%Y')
+    sold_on = '{} {}, {}'.format(sold.strftime('%b').upper(), sold.day, sold.year)
+    return '''<html><body>
+        <div class="ListingStatusBannerSection">SOLD ON {sold_on}</div>
+        <h1 class="address inline-block"><span class="street-address">{street}</span>
+        <span class="locality">Austin</span><span class="region">TX</span>
+        <span class="postal-code">{postal}</span></h1>
+        <div class="info-block price"><div class="statsValue">${price:,}</div></div>
+        <div class="info-block" data-rf-test-id="abp-beds"><div class="statsValue">{beds}</div></div>
+        <div class="info-block" data-rf-test-id="abp-baths"><div class="statsValue">{baths}</div></div>
+        <span class="entryItemContent">Year Built: {year}</span>
+        <span class="entryItemContent">School District: Austin ISD</span>
+        </body></html>'''.format(sold_on=sold_on, **home)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    homes = []
+    requests_served = Counter()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        m = re.search(r'/home/([0-9]+)$', path)
+        if m:
+            home = next((home for home in self.homes if home['id'] == int(m.group(1))), None)
+            if home is None:
+                return self.reply(404, 'text/html', b'')
+            return self.reply(200, 'text/html', home_page(home).encode('utf-8'), kind='home')
+        if '/city/' in path:
+            m = re.search(r'/page-([0-9]+)$', path)
+            page = search_page(matching_homes(self.homes, parse_filter_params(path)), int(m.group(1)) if m else 1)
+            return self.reply(200, 'text/html', page.encode('utf-8'), kind='page' if m else 'partition')
+        if path == CSV_PATH:
+            homes = matching_homes(self.homes, csv_params(urlparse(self.path).query))
+            body = csv_export(homes, 'http://' + self.headers['Host']).encode('utf-8')
+            return self.reply(200, 'text/csv', body, kind='csv')
+        self.reply(404, 'text/html', b'')
+
+    def reply(self, status, content_type, body, kind=None):
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.requests_served['{} {}'.format(kind or 'other', status)] += 1
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(homes, host='127.0.0.1', port=0):
+    """Serve homes from a background thread. Returns (server, site url)."""
+    StandInHandler.homes = homes
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}'.format(*server.server_address)
+
+def local_worker(coordinator_url, processes, worker_id):
+    # Own process group, so that killing the worker takes its pool down too.
+    os.setpgrp()
+    distributed_crawl.run_worker(coordinator_url, [], processes, worker_id, poll_seconds=1)
+
+def run_workers(coordinator_url, num_workers, processes, kill_after=None):
+    """Run num_workers local crawl workers until the frontier is exhausted.
+    With kill_after, the first worker is killed that many seconds in, so its
+    lease has to expire and the shard go to another worker.
+    """
+    workers = [multiprocessing.Process(target=local_worker, args=(coordinator_url, processes, 'local-{}'.format(i)))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    if kill_after is not None:
+        time.sleep(kill_after)
+        os.killpg(workers[0].pid, signal.SIGKILL)
+        print('Killed worker local-0')
+    for worker in workers:
+        worker.join()
+
+def distributed_harness(db_path, num_homes=200, num_workers=3, processes=8, lease_seconds=30, kill_after=None):
+    """Run the coordinator and num_workers workers of distributed_crawl
+    against the stand-in: the partition stage from the city search url,
+    then the home detail stage twice, the second time conditionally.
+    """
+    homes = stand_in_homes(num_homes)
+    _, site = start_stand_in(homes)
+    redfin_urls.SQLITE_DB_PATH = db_path
+    redfin_urls.create_tables_if_not_exist()
+    distributed_crawl.create_shard_table()
+
+    base_url = site + CITY_PATH
+    server = distributed_crawl.ThreadedXMLRPCServer(('127.0.0.1', 0), allow_none=True, logRequests=False)
+    server.register_instance(distributed_crawl.Coordinator(base_url, lease_seconds))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    coordinator_url = 'http://{}:{}'.format(*server.server_address)
+
+    distributed_crawl.seed_partition(base_url)
+    run_workers(coordinator_url, num_workers, processes)
+    # The pagination stage is not distributed; list the homes the way it would.
+    with sqlite3.connect(db_path) as db:
+        for home in homes:
+            upsert_listing(db, home['path'], {'STREET': home['street'], 'LOCALITY': 'Austin', 'REGION': 'TX',
+                                              'POSTAL_CODE': home['postal']})
+    for attempt in range(2):
+        with sqlite3.connect(db_path) as db:
+            db.execute("DELETE FROM SHARDS WHERE STAGE = 'homes'")
+        distributed_crawl.seed_homes(batch_size=25, site=site)
+        run_workers(coordinator_url, num_workers, processes, kill_after if attempt == 0 else None)
+
+    server.shutdown()
+    with sqlite3.connect(db_path) as db:
+        priced = db.execute('SELECT COUNT(*) FROM LISTING_DETAILS WHERE PRICE IS NOT NULL').fetchone()[0]
+        partitions = db.execute('SELECT COUNT(*) FROM URLS').fetchone()[0]
+    print('Shards: {}'.format(distributed_crawl.Coordinator(base_url).progress()))
+    print('Requests served: {}'.format(dict(StandInHandler.requests_served)))
+    print('{} partition urls, {} of {} homes priced'.format(partitions, priced, len(homes)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Redfin pages the crawler fetches.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='serve the stand-in until interrupted')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--homes', type=int, default=200)
+
+    harness_parser = subparsers.add_parser('distributed', help='run a local coordinator and workers against it')
+    harness_parser.add_argument('--db', default='stand-in.db')
+    harness_parser.add_argument('--homes', type=int, default=200)
+    harness_parser.add_argument('--workers', type=int, default=3)
+    harness_parser.add_argument('--processes', type=int, default=8)
+    harness_parser.add_argument('--lease-seconds', type=int, default=30)
+    harness_parser.add_argument('--kill-after', type=float, help='kill one worker this many seconds into the home stage')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server, site = start_stand_in(stand_in_homes(args.homes), args.host, args.port)
+        print('Stand-in listening on {}, search url {}, CSV endpoint {}'.format(site, site + CITY_PATH,
+                                                                                 site + CSV_PATH))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        distributed_harness(args.db, args.homes, args.workers, args.processes, args.lease_seconds, args.kill_after)
@@ -0,0 +1,250 @@
+import os
+import glob
+import json
+import math
+import time
+import hashlib
+import sqlite3
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from threadpoolctl import threadpool_limits
+
+from features import FEATURE_DIR, load_feature_matrix
+from price_model import MODEL_PATH, train_hist_gbm, evaluate, save_model
+
+# (scale, low, high) per HistGradientBoostingRegressor parameter.
+SEARCH_SPACE = {
+    'learning_rate': ('log', 0.01, 0.3),
+    'max_leaf_nodes': ('int', 15, 255),
+    'min_samples_leaf': ('int', 5, 200),
+    'l2_regularization': ('log', 1e-3, 10.0),
+    'max_features': ('float', 0.5, 1.0),
+}
+
+def create_trials_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS TUNING_TRIALS
+            (
+            SEARCH_ID      TEXT    NOT NULL,
+            TRIAL_ID       INT     NOT NULL,
+            RUNG           INT     NOT NULL,
+            PARAMS         TEXT    NOT NULL,
+            ROWS           INT,
+            SCORE          REAL,
+            FOLD_SCORES    TEXT,
+            ELAPSED_SECONDS REAL,
+            PRIMARY KEY (SEARCH_ID, TRIAL_ID, RUNG));''')
+    # What a search was started with, so that resuming it with other
+    # settings or on another feature matrix is caught instead of mixing runs.
+    conn.execute('''CREATE TABLE IF NOT EXISTS TUNING_SEARCHES
+            (
+            SEARCH_ID      TEXT    PRIMARY KEY,
+            SETTINGS       TEXT    NOT NULL,
+            STARTED_AT     TEXT);''')
+
+def sample_configs(n_configs, seed=0, space=SEARCH_SPACE):
+    """n_configs random parameter sets. The same seed gives the same
+    configurations, which is what lets an interrupted search resume.
+    """
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n_configs):
+        params = {}
+        for name, (scale, low, high) in space.items():
+            if scale == 'log':
+                params[name] = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+            elif scale == 'int':
+                params[name] = int(rng.integers(low, high + 1))
+            else:
+                params[name] = float(rng.uniform(low, high))
+        configs.append(params)
+    return configs
+
+def matrix_id(meta):
+    """Fingerprint of a feature matrix: rewriting it with any other rows
+    changes its meta.json (row count, LISTING_ID range, column statistics).
+    """
+    return hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()
+
+def cv_cache(feature_dir=FEATURE_DIR, n_folds=5, seed=0):
+    """Write folds-<n_folds>.npy (fold of every row) and order.npy (the order rows are
+    drawn in when a rung uses a subsample) next to the feature matrix, unless
+    they were already written for it: cv.json records the row count,
+    ROW_VERSION, largest LISTING_ID and seed they go with. Folds come from a hash of
+    LISTING_ID, so a listing stays in the same fold when the matrix is rebuilt.
+    """
+    _, _, listing_ids, meta = load_feature_matrix(feature_dir)
+    folds_path = os.path.join(feature_dir, 'folds-{}.npy'.format(n_folds))
+    order_path = os.path.join(feature_dir, 'order.npy')
+    stamp_path = os.path.join(feature_dir, 'cv.json')
+    stamp = {'rows': meta['rows'], 'max_version': meta['max_version'], 'max_listing_id': meta['max_listing_id'],
+             'seed': seed}
+    written = None
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            written = json.load(f)
+    if written != stamp:
+        for path in glob.glob(os.path.join(feature_dir, 'folds-*.npy')) + [order_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        with open(stamp_path, 'w') as f:
+            json.dump(stamp, f)
+    elif os.path.exists(folds_path) and os.path.exists(order_path):
+        return
+    hashed = (np.asarray(listing_ids, dtype=np.uint64) * np.uint64(2654435761)) % np.uint64(2 ** 32)
+    np.save(folds_path, (hashed % np.uint64(n_folds)).astype(np.int8))
+    np.save(order_path, np.random.default_rng(seed).permutation(meta['rows']))
+
+def run_trial(trial):
+    """Cross-validate one configuration on the first `rows` rows of the
+    cached order. Runs in a pool worker, single threaded so that the workers
+    do not fight over cores.
+    """
+    feature_dir, params, rows, n_folds, seed = trial
+    started = time.time()
+    X, y, _, meta = load_feature_matrix(feature_dir)
+    folds = np.load(os.path.join(feature_dir, 'folds-{}.npy'.format(n_folds)), mmap_mode='r')
+    # Sorted so that the reads walk the memmap front to back.
+    sample = np.sort(np.load(os.path.join(feature_dir, 'order.npy'), mmap_mode='r')[:rows])
+    sample_folds = folds[sample]
+    fold_scores = []
+    with threadpool_limits(1):
+        for fold in range(n_folds):
+            train, validation = sample[sample_folds != fold], sample[sample_folds == fold]
+            if not len(train) or not len(validation):
+                continue
+            model = train_hist_gbm(X[train], y[train], meta, validation_fraction=0, seed=seed, **params)
+            fold_scores.append(evaluate(model, X[validation], y[validation])['LOG_MAE'])
+    score = float(np.mean(fold_scores)) if fold_scores else None
+    return score, fold_scores, time.time() - started
+
+def trial_bytes(rows, n_features, n_folds):
+    """Rough peak memory of run_trial on `rows` rows: the float64 copy that
+    indexing X makes of the training folds, the estimator's one byte per
+    value binned copy and its per-row gradient buffers, and the validation
+    fold.
+    """
+    train_rows = rows * (n_folds - 1) // n_folds
+    return train_rows * (9 * n_features + 32) + (rows - train_rows) * 8 * n_features
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def best_params(conn, search_id):
+    """Parameters of the best configuration at the last rung of a finished
+    or interrupted search, or None if there is no such search.
+    """
+    create_trials_table(conn)
+    row = conn.execute("""
+        SELECT PARAMS FROM TUNING_TRIALS
+        WHERE SEARCH_ID = ? AND SCORE IS NOT NULL
+        ORDER BY RUNG DESC, SCORE LIMIT 1""", (search_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def successive_halving(conn, search_id, feature_dir=FEATURE_DIR, n_configs=27, eta=3, min_rows=20000,
+                       max_iter=300, n_folds=5, max_workers=None, seed=0, max_memory=None):
+    """Random search with successive halving. Every configuration is
+    cross-validated on min_rows rows; the best 1/eta move on to eta times as
+    many rows, until one configuration is left or the full matrix is used.
+    Each trial copies its training rows into memory, so a rung runs only as
+    many trials at once as fit in max_memory bytes (half the physical
+    memory by default).
+    Each finished trial is stored in TUNING_TRIALS as it completes, and
+    trials already there for search_id are not run again. A search can
+    only be resumed with the settings and feature matrix it was started
+    with; anything else raises ValueError.
+    Returns (best params, best score).
+    """
+    create_trials_table(conn)
+    cv_cache(feature_dir, n_folds, seed)
+    meta = load_feature_matrix(feature_dir)[3]
+    total_rows = meta['rows']
+    settings = json.dumps({'n_configs': n_configs, 'eta': eta, 'min_rows': min_rows, 'max_iter': max_iter,
+                           'n_folds': n_folds, 'seed': seed, 'space': SEARCH_SPACE,
+                           'rows': total_rows, 'matrix': matrix_id(meta)}, sort_keys=True)
+    row = conn.execute('SELECT SETTINGS FROM TUNING_SEARCHES WHERE SEARCH_ID = ?', (search_id,)).fetchone()
+    if row is None:
+        conn.execute('INSERT INTO TUNING_SEARCHES (SEARCH_ID, SETTINGS, STARTED_AT) VALUES (?, ?, ?)',
+                     (search_id, settings, time.strftime('%Y-%m-%dT%H:%M:%S')))
+        conn.commit()
+    elif row[0] != settings:
+        raise ValueError('Search {} was started with other settings or another feature matrix ({}); '
+                         'resume it with those or use a new search id'.format(search_id, row[0]))
+
+    configs = [dict(params, max_iter=max_iter) for params in sample_configs(n_configs, seed)]
+    # Trials are only reused if they ran this configuration on this rung's rows,
+    # which also covers searches stored before TUNING_SEARCHES existed.
+    done = {(trial_id, rung): score for trial_id, rung, params, rows, score in conn.execute("""
+        SELECT TRIAL_ID, RUNG, PARAMS, ROWS, SCORE FROM TUNING_TRIALS WHERE SEARCH_ID = ?""", (search_id,))
+            if trial_id < n_configs and json.loads(params) == configs[trial_id]
+            and rows == min(total_rows, min_rows * eta ** rung)}
+    if done:
+        print('Resuming search {}: {} trials already finished'.format(search_id, len(done)))
+
+    survivors = list(range(n_configs))
+    rung = 0
+    max_workers = max_workers or os.cpu_count()
+    max_memory = max_memory or physical_memory() // 2
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            rows = min(total_rows, min_rows * eta ** rung)
+            pending = [trial_id for trial_id in survivors if (trial_id, rung) not in done]
+            concurrency = max(1, min(max_workers, max_memory // trial_bytes(rows, len(meta['columns']), n_folds)))
+            if pending and concurrency < min(max_workers, len(pending)):
+                print('Rung {}: running {} trials at a time to stay within {} MB'.format(
+                    rung, concurrency, max_memory // 2 ** 20))
+            futures = {}
+            while pending or futures:
+                while pending and len(futures) < concurrency:
+                    trial_id = pending.pop(0)
+                    trial = (feature_dir, configs[trial_id], rows, n_folds, seed)
+                    futures[executor.submit(run_trial, trial)] = trial_id
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    trial_id = futures.pop(future)
+                    score, fold_scores, elapsed = future.result()
+                    conn.execute("""
+                        INSERT OR REPLACE INTO TUNING_TRIALS
+                        (SEARCH_ID, TRIAL_ID, RUNG, PARAMS, ROWS, SCORE, FOLD_SCORES, ELAPSED_SECONDS)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (search_id, trial_id, rung, json.dumps(configs[trial_id]), rows, score,
+                         json.dumps(fold_scores), elapsed))
+                    conn.commit()
+                    done[(trial_id, rung)] = score
+
+            ranked = sorted(survivors, key=lambda trial_id: (done[(trial_id, rung)] is None,
+                                                             done[(trial_id, rung)] or 0))
+            print('Rung {}: {} configurations on {} rows, best log MAE {}'.format(
+                rung, len(survivors), rows, done[(ranked[0], rung)]))
+            if len(ranked) == 1 or rows >= total_rows:
+                return configs[ranked[0]], done[(ranked[0], rung)]
+            survivors = ranked[:max(1, len(ranked) // eta)]
+            rung += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the price model with parallel successive halving.')
+    parser.add_argument('--db', default='redfin-scraper-data.db', help='where trial results are kept')
+    parser.add_argument('--search-id', default='price-model',
+                        help='rerun with the same id (and seed) to resume an interrupted search')
+    parser.add_argument('--feature-dir', default=FEATURE_DIR)
+    parser.add_argument('--configs', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--min-rows', type=int, default=20000)
+    parser.add_argument('--max-iter', type=int, default=300)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-memory-gb', type=float,
+                        help='memory the concurrent trials may use together, by default half the physical memory')
+    parser.add_argument('--output', default=MODEL_PATH, help='refit the best configuration on all rows and save it')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    params, score = successive_halving(conn, args.search_id, args.feature_dir, args.configs, args.eta,
+                                       args.min_rows, args.max_iter, args.folds, args.workers, args.seed,
+                                       int(args.max_memory_gb * 2 ** 30) if args.max_memory_gb else None)
+    conn.close()
+    print('Best configuration (log MAE {}): {}'.format(score, params))
+    X, y, _, meta = load_feature_matrix(args.feature_dir)
+    save_model(train_hist_gbm(X, y, meta, seed=args.seed, **params), args.output)